@@ -4,13 +4,22 @@ import os
 import sys
 import re
 import json
+import shlex
+import signal
+import select
 import subprocess
-from threading import Timer
+import time
+import glob
+import hashlib
+import struct
+import argparse
+from collections import OrderedDict
+from threading import Timer, Thread, Lock, Event, get_ident, enumerate as enumerate_threads
 import Xlib.threaded
 from Xlib import X, display, XK, Xatom, Xcursorfont, error
-from Xlib.ext import shape
+from Xlib.protocol import event
+from Xlib.ext import shape, randr
 from x11util import load_font
-from ewmh import EWMH
 
 # GLOBAL VARIABLES
 
@@ -32,19 +41,22 @@ FONT_OPTIONS = {
 }
 FONT_NAME = FONT_OPTIONS[5]
 CONFIG_FILE_PATH = "/etc/biscuitwm/biscuitwm.json"
-
-
-def run_command(command_string):
-    try:
-        subprocess.Popen(command_string)
-    except:
-        print("Unable to perform command")
+CACHE_DIR_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "biscuitwm"
+)
+LAUNCHER_HISTORY_FILE_PATH = os.path.join(CACHE_DIR_PATH, "launcher_history.json")
+WINDOW_GEOMETRY_FILE_PATH = os.path.join(CACHE_DIR_PATH, "window_geometry.json")
+TRACE_MAGIC = b"BWMTRACE"
+TRACE_VERSION = 2
+EVENT_BATCH_LIMIT = 256  # Most events handled between two flushes
 
 
 class SessionInfo(object):
     def __init__(self):
         self.session_name = "BiscuitWM"
-        self.kernel_version = os.popen('uname -rm').read()[:-1]
+        uname = os.uname()
+        self.kernel_version = uname.release + " " + uname.machine
 
 
 class PixelPalette(object):
@@ -83,7 +95,7 @@ class PixelPalette(object):
     def get_hex_pixel(self, hex_name):
         try:
             return self.colormap.alloc_named_color(hex_name).pixel
-        except:
+        except error.XError:
             return self.colormap.alloc_named_color(self.hex_map["white"]).pixel
 
 
@@ -123,53 +135,684 @@ class RepeatedTimer(object):
         self.is_running = False
 
 
+class SamplingProfiler(object):
+    '''
+    Samples the stacks of every WM thread at a fixed rate from a background
+    thread and counts them in the collapsed format read by flame graph
+    tools. Nothing runs between samples, so the WM keeps its normal speed
+    while being profiled.
+    '''
+
+    def __init__(self, interval=0.01, output_dir=CACHE_DIR_PATH):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.thread = None
+        self.stop_event = None
+        self.samples = {}  # Collapsed stack -> number of samples
+
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.samples = {}
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Returns the path the profile was written to
+        if self.thread is None:
+            return None
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        return self.write()
+
+    def run(self):
+        own_id = get_ident()
+        while not self.stop_event.wait(self.interval):
+            # Timer threads are numbered, drop the numbers so their samples add up
+            thread_names = {thread.ident: re.sub(r"-\d+", "", thread.name) for thread in enumerate_threads()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, "unknown thread"))
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+        with open(path, "w") as profile_file:
+            for stack, count in sorted(self.samples.items()):
+                profile_file.write("%s %d\n" % (stack, count))
+        return path
+
+
+class ServerResources(object):
+    '''
+    Fonts, cursors and GCs shared by everything the WM draws. Each one is
+    created on first use, reused afterwards and freed by free() when the
+    session ends.
+    '''
+
+    def __init__(self, dpy):
+        self.dpy = dpy
+        self.fonts = {}  # Font name -> font
+        self.cursors = {}  # Cursor font glyph -> cursor
+        self.gcs = {}  # Caller-chosen key -> GC
+        self.pixmaps = {}  # Caller-chosen key -> pre-rendered pixmap
+
+    def get_font(self, name):
+        font = self.fonts.get(name)
+        if font is None:
+            font = load_font(self.dpy, name)
+            self.fonts[name] = font
+        return font
+
+    def get_cursor(self, glyph=Xcursorfont.left_ptr):
+        cursor = self.cursors.get(glyph)
+        if cursor is None:
+            font = self.get_font("cursor")
+            cursor = font.create_glyph_cursor(font, glyph, glyph + 1, (65535, 65535, 65535), (0, 0, 0))
+            self.cursors[glyph] = cursor
+        return cursor
+
+    def get_gc(self, key, drawable, **values):
+        # GCs can be shared by drawables of the same depth, the key should say which
+        gc = self.gcs.get(key)
+        if gc is None:
+            gc = drawable.create_gc(**values)
+            self.gcs[key] = gc
+        return gc
+
+    def get_pixmap(self, key, drawable, width, height, depth, render):
+        # render(pixmap) draws the contents once, when the pixmap is created
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            pixmap = drawable.create_pixmap(width, height, depth)
+            render(pixmap)
+            self.pixmaps[key] = pixmap
+        return pixmap
+
+    def free_pixmap(self, key):
+        pixmap = self.pixmaps.pop(key, None)
+        if pixmap is not None:
+            pixmap.free()
+
+    def counts(self):
+        return {"font": len(self.fonts), "cursor": len(self.cursors), "gc": len(self.gcs), "pixmap": len(self.pixmaps)}
+
+    def free(self):
+        for pixmap in self.pixmaps.values():
+            pixmap.free()
+        for gc in self.gcs.values():
+            gc.free()
+        for cursor in self.cursors.values():
+            cursor.free()
+        for font in self.fonts.values():
+            font.close()
+        self.pixmaps = {}
+        self.gcs = {}
+        self.cursors = {}
+        self.fonts = {}
+
+
+class WallpaperCache(object):
+    '''
+    Wallpapers scaled to the screen, kept on disk as raw pixels in the
+    layout put_image takes. A cached file is named after the source path,
+    modification time and size and the target resolution, so it is only
+    decoded and scaled again when the image or the screen changes.
+    '''
+
+    def __init__(self, cache_dir=CACHE_DIR_PATH):
+        self.cache_dir = cache_dir
+
+    def get_cache_path(self, path, width, height, raw_mode):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = "%s:%d:%d:%dx%d:%s" % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, width, height, raw_mode)
+        return os.path.join(self.cache_dir, "wallpaper-%s.raw" % hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def load(self, path, width, height, raw_mode):
+        # raw_mode is the pixel layout of the display, "BGRX" or "XRGB"
+        cache_path = self.get_cache_path(path, width, height, raw_mode)
+        if cache_path is None:
+            print("Wallpaper not found: " + path)
+            return None
+        try:
+            with open(cache_path, "rb") as cache_file:
+                data = cache_file.read()
+            if len(data) == width * height * 4:
+                return data
+        except OSError:
+            pass
+        data = self.scale(path, width, height, raw_mode)
+        if data is not None:
+            self.store(cache_path, data)
+        return data
+
+    def scale(self, path, width, height, raw_mode):
+        # Pillow is only needed when there is no cached copy
+        try:
+            from PIL import Image
+        except ImportError:
+            print("Wallpapers need the Pillow library")
+            return None
+        try:
+            with Image.open(path) as source:
+                image = source.convert("RGB")
+        except OSError:
+            print("Cannot read wallpaper: " + path)
+            return None
+        # Fill the screen and crop whatever does not fit
+        scale = max(width / image.width, height / image.height)
+        scaled_width = max(width, round(image.width * scale))
+        scaled_height = max(height, round(image.height * scale))
+        image = image.resize((scaled_width, scaled_height), Image.LANCZOS)
+        left, top = (scaled_width - width) // 2, (scaled_height - height) // 2
+        image = image.crop((left, top, left + width, top + height))
+        return image.tobytes("raw", raw_mode)
+
+    def store(self, cache_path, data):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Only the current wallpaper is kept
+            for old_path in glob.glob(os.path.join(self.cache_dir, "wallpaper-*.raw")):
+                os.remove(old_path)
+            temp_path = cache_path + ".tmp"
+            with open(temp_path, "wb") as cache_file:
+                cache_file.write(data)
+            os.replace(temp_path, cache_path)
+        except OSError as err:
+            print("Cannot cache wallpaper: %s" % err)
+
+
+class CommandTrieNode(object):
+    __slots__ = ("children", "best")
+
+    def __init__(self):
+        self.children = {}
+        self.best = None
+
+
+class CommandIndex(object):
+    '''
+    Prefix trie of the executables found on $PATH, used by the deskbar launcher
+    for inline completion. Every node caches its best-ranked completion so a
+    lookup only walks the typed prefix. The trie is (re)built lazily on a
+    background thread, and only when the mtime of a $PATH directory changed.
+    '''
+
+    def __init__(self, history_path=LAUNCHER_HISTORY_FILE_PATH):
+        self.history_path = history_path
+        self.launch_counts = self.read_history()
+        self.directories = {}  # Directory -> (mtime, executable names)
+        self.root = CommandTrieNode()
+        self.build_thread = None
+        self.lock = Lock()
+
+    def read_history(self):
+        if self.history_path is None:
+            return {}
+        try:
+            with open(self.history_path, "r") as history_file:
+                return {str(name): int(count) for name, count in json.load(history_file).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def write_history(self):
+        if self.history_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+            temp_path = self.history_path + ".tmp"
+            with open(temp_path, "w") as history_file:
+                json.dump(self.launch_counts, history_file)
+            os.replace(temp_path, self.history_path)
+        except OSError:
+            print("Unable to save launcher history")
+
+    def rank(self, name):
+        # Most launched first, then shortest, then alphabetical
+        return -self.launch_counts.get(name, 0), len(name), name
+
+    def get_path_directories(self):
+        directories = []
+        for directory in os.environ.get("PATH", "").split(os.pathsep):
+            if len(directory) > 0 and directory not in directories:
+                directories.append(directory)
+        return directories
+
+    def scan_directory(self, directory):
+        names = set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and os.access(entry.path, os.X_OK):
+                            names.add(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return names
+
+    def refresh(self):
+        changed = False
+        directories = {}
+        for directory in self.get_path_directories():
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            cached = self.directories.get(directory)
+            if cached is not None and cached[0] == mtime:
+                directories[directory] = cached
+            else:
+                directories[directory] = (mtime, self.scan_directory(directory))
+                changed = True
+        if changed or directories.keys() != self.directories.keys():
+            names = set()
+            for mtime, directory_names in directories.values():
+                names.update(directory_names)
+            root = self.build_trie(names)
+            with self.lock:
+                self.directories = directories
+                self.root = root
+
+    def refresh_async(self):
+        if self.build_thread is not None and self.build_thread.is_alive():
+            return
+        self.build_thread = Thread(target=self.refresh, name="CommandIndex", daemon=True)
+        self.build_thread.start()
+
+    def build_trie(self, names):
+        root = CommandTrieNode()
+        for name in names:
+            rank = self.rank(name)
+            node = root
+            for character in name:
+                child = node.children.get(character)
+                if child is None:
+                    child = CommandTrieNode()
+                    node.children[character] = child
+                node = child
+                if node.best is None or rank < self.rank(node.best):
+                    node.best = name
+        return root
+
+    def complete(self, prefix):
+        # Returns the best full command name starting with prefix, if any
+        if len(prefix) == 0:
+            return None
+        node = self.root
+        for character in prefix:
+            node = node.children.get(character)
+            if node is None:
+                return None
+        return node.best
+
+    def is_indexed(self, name):
+        return any(name in names for mtime, names in self.directories.values())
+
+    def record_launch(self, name):
+        with self.lock:
+            # Typos and paths are not completed, so they are not ranked either
+            if not self.is_indexed(name):
+                return
+            self.launch_counts[name] = self.launch_counts.get(name, 0) + 1
+            # Counts only grow, so only the launched name can overtake a cached best
+            rank = self.rank(name)
+            node = self.root
+            for character in name:
+                node = node.children[character]
+                if node.best is None or rank < self.rank(node.best):
+                    node.best = name
+        self.write_history()
+
+
+class ProcessSupervisor(object):
+    '''
+    Launches commands for the WM and reaps them once they exit, so that
+    children never linger as zombies. posix_spawn uses a vfork-style path,
+    which avoids copying the address space of the WM for every launch.
+    '''
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run  # Only record commands, used when replaying traces
+        self.launched_commands = []
+        self.children = {}  # PID -> command string
+        self.window_pids = {}  # Window ID -> PID of the launched command
+
+    def install(self):
+        signal.signal(signal.SIGCHLD, self.handle_sigchld)
+
+    def uninstall(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    def handle_sigchld(self, signum, frame):
+        self.reap()
+
+    def spawn(self, command_string):
+        try:
+            args = shlex.split(command_string)
+        except ValueError:
+            print("Unable to parse command: " + command_string)
+            return None
+        if len(args) == 0:
+            return None
+        if self.dry_run:
+            self.launched_commands.append(command_string)
+            return None
+        try:
+            if hasattr(os, "posix_spawnp"):
+                pid = os.posix_spawnp(args[0], args, os.environ, setsid=True)
+            else:
+                pid = subprocess.Popen(args, start_new_session=True).pid
+        except OSError:
+            print("Unable to perform command: " + command_string)
+            return None
+        self.children[pid] = command_string
+        # SIGCHLD may have been handled before the PID was known, so reap a command that already exited
+        self.reap()
+        return pid
+
+    def reap(self):
+        for pid in list(self.children.keys()):
+            try:
+                reaped_pid, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                reaped_pid = pid
+            if reaped_pid != 0:
+                self.children.pop(pid, None)
+                for window_id in [w for w, p in self.window_pids.items() if p == pid]:
+                    del self.window_pids[window_id]
+
+    def adopt_children(self, children):
+        # Commands launched before a restart are still children of the process, so they are reaped here
+        self.children.update(children)
+        self.reap()
+
+    def is_launched_pid(self, pid):
+        return pid in self.children
+
+    def claim_window(self, window_id, pid):
+        if pid in self.children:
+            self.window_pids[window_id] = pid
+
+    def release_window(self, window_id):
+        self.window_pids.pop(window_id, None)
+
+    def get_window_command(self, window_id):
+        pid = self.window_pids.get(window_id)
+        if pid is None:
+            return None
+        return self.children.get(pid)
+
+
 class DeskbarItem(object):
-    def __init__(self, name, text="", width=0, interval=None, function=None, enabled=True):
+    def __init__(self, name, text="", width=0, enabled=True):
         self.name = name
         self.text = text
         self.width = width
-        self.interval = interval
-        self.function = function
         self.enabled = enabled
-        if interval is not None and function is not None:
-            self.rt_event = RepeatedTimer(interval, function)
-        else:
-            self.rt_event = None
 
-    def set_rt_event(self, interval, function):
-        self.interval = interval
-        self.function = function
-        self.rt_event = RepeatedTimer(interval, function)
 
-    def unset_rt_event(self):
-        if self.rt_event is not None:
-            self.rt_event.stop()
-            self.rt_event = None
-            self.interval = None
-            self.function = None
+class DeskbarItemProvider(object):
+    '''
+    Produces the text of one trailing deskbar item. sources lists the files
+    the provider reads; DeskbarSampler reads each of them once per tick and
+    hands the contents to sample() as a path -> text dict.
+    '''
+    name = "Item"
+    interval = 1
+    sources = ()
+
+    def __init__(self, prefs):
+        self.prefs = prefs
+
+    def sample(self, readings):
+        return ""
+
+
+class ClockProvider(DeskbarItemProvider):
+    name = "Clock"
+
+    def __init__(self, prefs):
+        super().__init__(prefs)
+        self.time_format = self.get_time_format()
+
+    def get_time_format(self):
+        time_format = ""
+        if self.prefs.deskbar["clock"]["show_day"] == 1:
+            time_format += "%a "
+        if self.prefs.deskbar["clock"]["show_date"] == 1:
+            time_format += "%d %b "
+        time_format += "%I:%M"
+        if self.prefs.deskbar["clock"]["show_seconds"] == 1:
+            time_format += ":%S"
+        time_format += " %p"
+        return time_format
+
+    def sample(self, readings):
+        return time.strftime(self.time_format).replace("AM", "am").replace("PM", "pm")
+
+
+class MemoryProvider(DeskbarItemProvider):
+    name = "Memory Usage"
+    interval = 10
+    sources = ("/proc/meminfo",)
+
+    def sample(self, readings):
+        meminfo = {}
+        for line in (readings["/proc/meminfo"] or "").splitlines():
+            key, _, value = line.partition(":")
+            meminfo[key] = value.split()[0] if len(value.split()) > 0 else "0"
+        try:
+            total = int(meminfo["MemTotal"])
+            available = int(meminfo["MemAvailable"])
+        except (KeyError, ValueError):
+            return None
+        return "MEM: %.2f%%" % ((total - available) * 100 / total)
+
+
+class CpuProvider(DeskbarItemProvider):
+    name = "CPU Usage"
+    interval = 2
+    sources = ("/proc/stat",)
+
+    def __init__(self, prefs):
+        super().__init__(prefs)
+        self.last_total = None
+        self.last_idle = None
+
+    def sample(self, readings):
+        lines = (readings["/proc/stat"] or "").splitlines()
+        if len(lines) == 0 or not lines[0].startswith("cpu "):
+            return None
+        fields = [int(field) for field in lines[0].split()[1:9]]
+        total = sum(fields)
+        idle = fields[3] + fields[4]  # idle + iowait
+        usage = 0
+        if self.last_total is not None and total > self.last_total:
+            usage = 100 * (1 - (idle - self.last_idle) / (total - self.last_total))
+        self.last_total, self.last_idle = total, idle
+        return "CPU: %d%%" % round(usage)
+
+
+class LoadProvider(DeskbarItemProvider):
+    name = "Load Average"
+    interval = 5
+    sources = ("/proc/loadavg",)
+
+    def sample(self, readings):
+        fields = (readings["/proc/loadavg"] or "").split()
+        if len(fields) == 0:
+            return None
+        return "LOAD: " + fields[0]
+
+
+class NetworkProvider(DeskbarItemProvider):
+    name = "Network"
+    interval = 2
+    sources = ("/proc/net/dev",)
+
+    def __init__(self, prefs):
+        super().__init__(prefs)
+        self.last_bytes = None
+        self.last_time = None
+
+    def format_rate(self, rate):
+        for unit in ("B", "K", "M"):
+            if rate < 1024:
+                return "%d%s" % (rate, unit)
+            rate /= 1024
+        return "%dG" % rate
+
+    def sample(self, readings):
+        received, sent = 0, 0
+        for line in (readings["/proc/net/dev"] or "").splitlines()[2:]:
+            interface, _, counters = line.partition(":")
+            counters = counters.split()
+            if interface.strip() == "lo" or len(counters) < 9:
+                continue
+            received += int(counters[0])
+            sent += int(counters[8])
+        now = time.monotonic()
+        received_rate, sent_rate = 0, 0
+        if self.last_bytes is not None and now > self.last_time:
+            received_rate = max(0, received - self.last_bytes[0]) / (now - self.last_time)
+            sent_rate = max(0, sent - self.last_bytes[1]) / (now - self.last_time)
+        self.last_bytes, self.last_time = (received, sent), now
+        return "NET: %s/%s" % (self.format_rate(received_rate), self.format_rate(sent_rate))
+
+
+class BatteryProvider(DeskbarItemProvider):
+    name = "Battery"
+    interval = 30
+
+    def __init__(self, prefs):
+        super().__init__(prefs)
+        batteries = sorted(glob.glob("/sys/class/power_supply/BAT*"))
+        if len(batteries) > 0:
+            self.sources = (os.path.join(batteries[0], "capacity"), os.path.join(batteries[0], "status"))
+
+    def sample(self, readings):
+        if len(self.sources) == 0 or readings[self.sources[0]] is None:
+            return None
+        status = (readings[self.sources[1]] or "").strip()
+        return "BAT: " + readings[self.sources[0]].strip() + "%" + ("+" if status == "Charging" else "")
+
+
+DESKBAR_ITEM_PROVIDERS = {
+    "clock": ClockProvider,
+    "memory": MemoryProvider,
+    "cpu": CpuProvider,
+    "load": LoadProvider,
+    "network": NetworkProvider,
+    "battery": BatteryProvider
+}
+
+
+class DeskbarSampler(object):
+    '''
+    Runs every deskbar item provider from a single timer. Each tick reads the
+    files needed by the providers that are due exactly once, and the deskbars
+    are only redrawn when some item's text actually changed.
+    '''
+
+    def __init__(self, prefs):
+        self.providers = {}  # Provider key -> DeskbarItemProvider, in deskbar order
+        for key in prefs.deskbar.get("items", ["clock", "memory"]):
+            if key == "clock" and prefs.deskbar["clock"]["enabled"] != 1:
+                continue
+            if key not in DESKBAR_ITEM_PROVIDERS:
+                print("Unknown deskbar item: " + key)
+                continue
+            self.providers[key] = DESKBAR_ITEM_PROVIDERS[key](prefs)
+        self.texts = {key: "" for key in self.providers}
+        self.next_sample_times = {key: 0 for key in self.providers}
+        self.deskbars = []
+        self.sample_rt = None
+
+    def read_sources(self, paths):
+        readings = {}
+        for path in paths:
+            try:
+                with open(path, "r") as source:
+                    readings[path] = source.read()
+            except OSError:
+                readings[path] = None
+        return readings
+
+    def sample(self):
+        now = time.monotonic()
+        due = [key for key in self.providers if self.next_sample_times[key] <= now]
+        if len(due) == 0:
+            return False
+        paths = set()
+        for key in due:
+            paths.update(self.providers[key].sources)
+        readings = self.read_sources(paths)
+        changed = False
+        for key in due:
+            provider = self.providers[key]
+            self.next_sample_times[key] = now + provider.interval
+            text = provider.sample(readings)
+            if text is not None and text != self.texts[key]:
+                self.texts[key] = text
+                changed = True
+        return changed
+
+    def tick(self):
+        if self.sample():
+            for deskbar in self.deskbars:
+                deskbar.set_item_texts(self.texts)
+                deskbar.update()
+
+    def subscribe(self, deskbar):
+        self.deskbars.append(deskbar)
+        deskbar.set_item_texts(self.texts)
+
+    def unsubscribe(self, deskbar):
+        if deskbar in self.deskbars:
+            self.deskbars.remove(deskbar)
 
     def start(self):
-        if self.rt_event is not None:
-            self.rt_event.start()
+        self.sample()
+        if self.sample_rt is None:
+            self.sample_rt = RepeatedTimer(1, self.tick)
 
     def stop(self):
-        if self.rt_event is not None:
-            self.rt_event.stop()
+        if self.sample_rt is not None:
+            self.sample_rt.stop()
+            self.sample_rt = None
 
 
 class Deskbar(object):
     def __init__(
-            self, ewmh, dpy, dpy_root, screen, display_dimensions,
+            self, dpy, dpy_root, screen, display_dimensions,
             wm_window_type, wm_window_types, wm_state, wm_window_status,
-            prefs, session_info
+            prefs, session_info, sampler, resources
     ):
-        self.ewmh = ewmh
         self.dpy = dpy
         self.dpy_root = dpy_root
         self.screen = screen
         self.colormap = self.screen.default_colormap
         self.pixel_palette = PixelPalette(self.colormap)
-        self.system_font = load_font(self.dpy, FONT_NAME)
+        self.resources = resources
+        self.system_font = self.resources.get_font(FONT_NAME)
         self.display_dimensions = display_dimensions
 
         self.wm_window_type = wm_window_type
@@ -179,7 +822,7 @@ class Deskbar(object):
 
         self.prefs = prefs
         self.session_info = session_info
-        self.time_command = self.set_get_current_time_command()
+        self.sampler = sampler
 
         self.border_width = 1
         self.height = 20
@@ -192,6 +835,7 @@ class Deskbar(object):
         self.color_scheme = self.get_deskbar_color_scheme()
 
         self.command_string = ""
+        self.command_completion = ""
 
         self.deskbar = None
         self.deskbar_gc = None
@@ -211,32 +855,24 @@ class Deskbar(object):
                     "Launcher",
                     text=self.command_string,
                     enabled=False
+                ),
+                "switcher": DeskbarItem(
+                    "Window Switcher",
+                    enabled=False
                 )
             },
             "trailing": {
-                "memory_usage": DeskbarItem(
-                    "Memory Usage",
-                    interval=10,
-                    function=self.set_memory_usage
-                ),
-                "timestamp": DeskbarItem(
-                    "Clock",
-                    interval=1 if self.prefs.deskbar["clock"]["show_seconds"] == 1 else 30,
-                    function=self.set_timestamp,
-                    enabled=self.prefs.deskbar["clock"]["enabled"] == 1
-                ),
+                key: DeskbarItem(provider.name) for key, provider in self.sampler.providers.items()
             },
         }
 
         # Leading items drawn from left to right
         # Trailing items drawn from right to left
         self.deskbar_items_order = {
-            "leading": ["window_count", "active_window_title", "launcher"],
-            "trailing": ["timestamp", "memory_usage"]
+            "leading": ["window_count", "active_window_title", "launcher", "switcher"],
+            "trailing": list(self.sampler.providers.keys())
         }
 
-        self.deskbar_update_rt = RepeatedTimer(1, self.update)
-
     def launcher_is_running(self):
         return self.deskbar_items["leading"]["launcher"].enabled
 
@@ -244,6 +880,20 @@ class Deskbar(object):
         print("Deskbar launcher mode: " + str(state))
         self.deskbar_items["leading"]["launcher"].enabled = state
         self.command_string = ""
+        self.command_completion = ""
+        self.update()
+
+    def switcher_is_running(self):
+        return self.deskbar_items["leading"]["switcher"].enabled
+
+    def show_switcher(self, text):
+        self.deskbar_items["leading"]["switcher"].enabled = True
+        self.deskbar_items["leading"]["switcher"].text = text
+        self.update()
+
+    def hide_switcher(self):
+        self.deskbar_items["leading"]["switcher"].enabled = False
+        self.deskbar_items["leading"]["switcher"].text = ""
         self.update()
 
     def set_active_window_title(self, window_title):
@@ -260,53 +910,23 @@ class Deskbar(object):
         self.deskbar_items["leading"]["window_count"].text = window_count_string
         self.deskbar_items["leading"]["active_window_title"].width = self.get_string_physical_width(window_count_string)
 
-    def set_memory_usage(self):
-        self.deskbar_items["trailing"]["memory_usage"].text = "MEM: " + self.get_memory_usage() + "%"
-        self.deskbar_items["trailing"]["memory_usage"].width = self.get_string_physical_width(
-            self.deskbar_items["trailing"]["memory_usage"].text)
-
-    def set_timestamp(self):
-        self.deskbar_items["trailing"]["timestamp"].text = self.get_current_time()
-        self.deskbar_items["trailing"]["timestamp"].width = self.get_string_physical_width(
-            self.deskbar_items["trailing"]["timestamp"].text
-        )
-
-    def set_get_current_time_command(self):
-        command = 'date +"'
-        if self.prefs.deskbar["clock"]["show_day"] == 1:
-            command += '%a '
-        if self.prefs.deskbar["clock"]["show_date"] == 1:
-            command += '%d %b '
-        command += '%I:%M'
-        if self.prefs.deskbar["clock"]["show_seconds"] == 1:
-            command += ':%S'
-        command += ' %P"'
-        return command
+    def set_item_texts(self, texts):
+        for key, text in texts.items():
+            item = self.deskbar_items["trailing"].get(key)
+            if item is not None and item.text != text:
+                item.text = text
+                item.width = self.get_string_physical_width(text)
 
     def get_string_physical_width(self, text):
-        font = self.dpy.open_font(FONT_NAME)
-        result = font.query_text_extents(text.encode())
+        result = self.system_font.query_text_extents(text.encode())
         return result.overall_width
 
-    def get_memory_usage(self):
-        return os.popen("free -m | awk 'NR==2{printf $3*100/$2}' | xargs printf '%.2f'").read()[:-1]
-
-    def get_current_time(self):
-        return os.popen(self.time_command).read()[:-1]
-
     def start_repeated_events(self):
-        for item in self.deskbar_items["leading"].values():
-            item.start()
-        for item in self.deskbar_items["trailing"].values():
-            item.start()
-        self.deskbar_update_rt.start()
+        # Status items are sampled by the shared DeskbarSampler
+        self.sampler.subscribe(self)
 
     def stop_repeated_events(self):
-        for item in self.deskbar_items["leading"].values():
-            item.stop()
-        for item in self.deskbar_items["trailing"].values():
-            item.stop()
-        self.deskbar_update_rt.stop()
+        self.sampler.unsubscribe(self)
 
     def get_deskbar_color_scheme(self):
         background_pixel = self.pixel_palette.get_named_pixel("white")
@@ -330,12 +950,16 @@ class Deskbar(object):
         background_pixel, foreground_pixel = self.color_scheme["bg"], self.color_scheme["fg"]
 
         self.deskbar = self.dpy_root.create_window(
-            -self.border_width, -self.border_width, screen_width, self.height, self.border_width,
+            self.display_dimensions.x - self.border_width, self.display_dimensions.y - self.border_width,
+            screen_width, self.height, self.border_width,
             self.screen.root_depth,
             background_pixel=background_pixel,
             event_mask=X.StructureNotifyMask | X.ExposureMask | X.ButtonPressMask | X.ButtonReleaseMask,
         )
-        self.deskbar_gc = self.deskbar.create_gc(
+        # Deskbars share one GC per colour scheme, created on the root as it has the same depth
+        self.deskbar_gc = self.resources.get_gc(
+            ("deskbar", foreground_pixel, background_pixel),
+            self.dpy_root,
             font=self.system_font,
             foreground=foreground_pixel,
             background=background_pixel,
@@ -348,21 +972,33 @@ class Deskbar(object):
             [self.wm_window_types["dock"]],
             X.PropModeReplace
         )
-        self.ewmh.setWmState(self.deskbar, 1, "_NET_WM_DESKTOP")
-        self.ewmh.setWmState(self.deskbar, 1, "_NET_WM_STATE_SKIP_TASKBAR")
-        self.ewmh.setWmState(self.deskbar, 1, "_NET_WM_STATE_ABOVE")
+        # Not mapped yet, so the window sets its own state instead of asking the WM
+        self.deskbar.change_property(
+            self.wm_state,
+            Xatom.ATOM,
+            32,
+            [self.wm_window_status["skip_taskbar"], self.wm_window_status["above"]],
+            X.PropModeReplace
+        )
+        self.deskbar.change_property(self.wm_window_status["desktop"], Xatom.CARDINAL, 32, [0xFFFFFFFF], X.PropModeReplace)
 
         self.deskbar.map()  # Draw deskbar
-        self.set_timestamp()  # Set initial timestamp
-        self.set_memory_usage()  # Set initial memory usage percentage
-        self.update()  # Initial update
         self.start_repeated_events()  # Start deskbar updates
+        self.update()  # Initial update
 
     def update(self):
         self.deskbar.clear_area()
 
         # Leading items
-        if self.deskbar_items["leading"]["launcher"].enabled is False:
+        if self.deskbar_items["leading"]["switcher"].enabled is True:
+            # The window switcher preview replaces the other leading items
+            self.deskbar.draw_text(
+                self.deskbar_gc,
+                self.padding_leading,
+                self.text_y_alignment,
+                self.deskbar_items["leading"]["switcher"].text.encode('utf-8')
+            )
+        elif self.deskbar_items["leading"]["launcher"].enabled is False:
             for item_key in self.deskbar_items_order["leading"]:
                 item = self.deskbar_items["leading"][item_key]
                 if item.enabled is True:
@@ -378,14 +1014,14 @@ class Deskbar(object):
                 self.deskbar_gc,
                 self.padding_leading,
                 self.text_y_alignment,
-                (self.command_string + "|").encode('utf-8')
+                (self.command_string + "|" + self.command_completion).encode('utf-8')
             )
 
         # Trailing items
         spacing_from_trailing_end = self.padding_trailing
         for item_key in self.deskbar_items_order["trailing"]:
             item = self.deskbar_items["trailing"][item_key]
-            if item.enabled is True:
+            if item.enabled is True and len(item.text) > 0:
                 self.deskbar.draw_text(
                     self.deskbar_gc,
                     self.display_dimensions.width - (item.width + spacing_from_trailing_end),
@@ -398,28 +1034,588 @@ class Deskbar(object):
         self.deskbar_items["leading"]["window_count"].enabled = not self.deskbar_items["leading"]["window_count"].enabled
         self.deskbar_items["leading"]["active_window_title"].enabled = not self.deskbar_items["leading"]["window_count"].enabled
 
+    def count_resources(self):
+        # Server-side resources owned by this deskbar, shared ones are counted by ServerResources
+        return 1 if self.deskbar is not None else 0
+
+    def stop(self):
+        self.stop_repeated_events()
+        if self.deskbar is not None:
+            self.deskbar.destroy()
+            self.deskbar = None
+            self.deskbar_gc = None
+
+class Geometry(object):
+    __slots__ = ("x", "y", "width", "height")
+
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def __eq__(self, other):
+        return isinstance(other, Geometry) and self.as_tuple() == other.as_tuple()
+
+    def __hash__(self):
+        return hash(self.as_tuple())
+
+    def as_tuple(self):
+        return self.x, self.y, self.width, self.height
+
+    def as_dict(self):
+        return {"x": self.x, "y": self.y, "width": self.width, "height": self.height}
+
+    def contains(self, x, y):
+        return self.x <= x < self.x + self.width and self.y <= y < self.y + self.height
+
+    def distance_to(self, x, y):
+        dx = max(self.x - x, 0, x - (self.x + self.width - 1))
+        dy = max(self.y - y, 0, y - (self.y + self.height - 1))
+        return dx * dx + dy * dy
+
+
+class WindowRule(object):
+    __slots__ = ("window_type", "title", "actions")
+
+    def __init__(self, window_type, title, actions):
+        self.window_type = window_type  # Atom, or None to match any type
+        self.title = title  # Compiled pattern, or None to match any title
+        self.actions = actions
+
+
+class WindowRules(object):
+    '''
+    Per-application rules from prefs.rules, compiled once at startup. Each
+    WM_CLASS named by a rule gets a ready-made list of the rules that can
+    apply to it, so finding a window's rules is a single dict lookup, and
+    title patterns are compiled up front.
+    '''
+    ACTIONS = ("position", "x", "y", "width", "height", "border_width", "focus")
+
+    def __init__(self, rules, window_types):
+        # window_types maps type names such as "dialog" to their atoms
+        class_rules = {}  # WM_CLASS -> [(index, WindowRule)]
+        generic_rules = []  # [(index, WindowRule)] of rules without a class
+        for index, rule in enumerate(rules):
+            match = rule.get("match", {})
+            window_type = None
+            if "type" in match:
+                window_type = window_types.get(match["type"])
+                if window_type is None:
+                    print("Unknown window type in window rule %d: %s" % (index, match["type"]))
+                    continue
+            title = None
+            if "title" in match:
+                try:
+                    title = re.compile(match["title"])
+                except re.error as err:
+                    print("Invalid title pattern in window rule %d: %s" % (index, err))
+                    continue
+            compiled = WindowRule(window_type, title, {key: rule[key] for key in self.ACTIONS if key in rule})
+            if "class" in match:
+                class_rules.setdefault(match["class"], []).append((index, compiled))
+            else:
+                generic_rules.append((index, compiled))
+        # Rules without a class apply to every window, merged in config order
+        self.class_rules = {
+            window_class: [compiled for index, compiled in sorted(indexed + generic_rules, key=lambda item: item[0])]
+            for window_class, indexed in class_rules.items()
+        }
+        self.generic_rules = [compiled for index, compiled in generic_rules]
+
+    def has_rules(self):
+        return len(self.class_rules) > 0 or len(self.generic_rules) > 0
+
+    def match(self, window_class, window_type, get_title):
+        # Actions of all matching rules, later rules win. get_title is only called if a rule needs the title.
+        actions = {}
+        title = None
+        for rule in self.class_rules.get(window_class, self.generic_rules):
+            if rule.window_type is not None and rule.window_type != window_type:
+                continue
+            if rule.title is not None:
+                if title is None:
+                    title = get_title()
+                if rule.title.search(title) is None:
+                    continue
+            actions.update(rule.actions)
+        return actions
+
+
+class GeometryStore(object):
+    '''
+    The geometry each application's normal window last had when it closed,
+    by WM_CLASS, so applications reopen where they were. Written to disk
+    whenever a geometry changes.
+    '''
+
+    def __init__(self, path=WINDOW_GEOMETRY_FILE_PATH):
+        self.path = path
+        self.geometries = self.read()  # WM_CLASS -> Geometry
+
+    def read(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, "r") as geometry_file:
+                return {
+                    str(window_class): Geometry(*[int(value) for value in values])
+                    for window_class, values in json.load(geometry_file).items()
+                }
+        except (OSError, ValueError, TypeError, AttributeError):
+            return {}
+
+    def write(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as geometry_file:
+                json.dump({
+                    window_class: geometry.as_tuple() for window_class, geometry in self.geometries.items()
+                }, geometry_file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            print("Unable to save window geometry")
+
+    def get(self, window_class):
+        return self.geometries.get(window_class)
+
+    def remember(self, window_class, geometry):
+        if self.geometries.get(window_class) == geometry:
+            return
+        self.geometries[window_class] = geometry
+        self.write()
+
+
+class MonitorLayout(object):
+    '''
+    Cached geometry of each output, queried from the display backend and
+    refreshed only when the server reports a screen change. The first
+    monitor is the primary output.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.monitors = []
+        self.refresh()
+
+    def refresh(self):
+        # Returns whether the layout changed
+        monitors = self.backend.query_monitors()
+        if len(monitors) == 0:
+            geometry = self.backend.get_root_geometry()
+            monitors = [Geometry(0, 0, geometry.width, geometry.height)]
+        changed = monitors != self.monitors
+        self.monitors = monitors
+        return changed
+
+    def primary(self):
+        return self.monitors[0]
+
+    def monitor_at(self, x, y):
+        for monitor in self.monitors:
+            if monitor.contains(x, y):
+                return monitor
+        return min(self.monitors, key=lambda monitor: monitor.distance_to(x, y))
+
+    def monitor_for_geometry(self, x, y, width, height):
+        return self.monitor_at(x + width // 2, y + height // 2)
+
+
+class StackingOrder(object):
+    '''
+    Local copy of the stacking order of the root window's children, kept up to
+    date from SubstructureNotify events so the WM can tell what is on top
+    without querying the server.
+    '''
+
+    def __init__(self, dpy_root):
+        self.dpy_root = dpy_root
+        self.window_ids = []  # Bottom to top
+        self.overlay_ids = set()  # WM windows kept above everything else
+
+    def reset(self, windows):
+        self.window_ids = [window.id for window in windows]
+
+    def add_overlay(self, window_id):
+        self.overlay_ids.add(window_id)
+
+    def remove_overlay(self, window_id):
+        self.overlay_ids.discard(window_id)
+
+    def top(self):
+        if len(self.window_ids) == 0:
+            return None
+        return self.window_ids[-1]
+
+    def has_window_above(self, window_id):
+        # Whether a window other than the WM's overlays is stacked above this one
+        if window_id not in self.window_ids:
+            return True
+        for stacked_id in self.window_ids[self.window_ids.index(window_id) + 1:]:
+            if stacked_id not in self.overlay_ids:
+                return True
+        return False
+
+    def is_top(self, window_id):
+        # Whether the window is the topmost one, not counting the WM's overlays
+        for stacked_id in reversed(self.window_ids):
+            if stacked_id not in self.overlay_ids:
+                return stacked_id == window_id
+        return False
+
+    def raise_window(self, window_id):
+        self.remove(window_id)
+        self.window_ids.append(window_id)
+
+    def lower_window(self, window_id):
+        self.remove(window_id)
+        self.window_ids.insert(0, window_id)
+
+    def remove(self, window_id):
+        if window_id in self.window_ids:
+            self.window_ids.remove(window_id)
+
+    def restack(self, window_id, sibling_id):
+        if sibling_id == X.NONE:
+            self.lower_window(window_id)
+        elif sibling_id in self.window_ids and sibling_id != window_id:
+            self.remove(window_id)
+            self.window_ids.insert(self.window_ids.index(sibling_id) + 1, window_id)
+        else:
+            # Unknown sibling, assume the worst and treat the window as on top
+            self.raise_window(window_id)
+
+    def handle_event(self, ev):
+        if ev.type == X.CreateNotify:
+            if ev.parent == self.dpy_root:
+                self.raise_window(ev.window.id)
+        elif ev.type == X.DestroyNotify:
+            if ev.event == self.dpy_root:
+                self.remove(ev.window.id)
+        elif ev.type == X.ConfigureNotify:
+            if ev.event == self.dpy_root:
+                self.restack(ev.window.id, getattr(ev.above_sibling, "id", X.NONE))
+        elif ev.type == X.CirculateNotify:
+            if ev.event == self.dpy_root:
+                if ev.place == X.PlaceOnTop:
+                    self.raise_window(ev.window.id)
+                else:
+                    self.lower_window(ev.window.id)
+        elif ev.type == X.ReparentNotify:
+            if ev.parent == self.dpy_root:
+                self.raise_window(ev.window.id)
+            elif ev.event == self.dpy_root:
+                self.remove(ev.window.id)
+
+
+class FocusPolicy(object):
+    '''
+    Turns pointer crossings into focus changes. A crossing only notes the
+    window under the pointer, which is focused once the pointer has rested
+    on it for the hover delay, so sweeping the pointer across several
+    windows focuses just the one it settles on.
+    '''
+
+    def __init__(self, prefs, clock=time.monotonic):
+        self.clock = clock
+        self.focus_on_hover = prefs.placement.get("focus_on_hover", 1) == 1
+        self.raise_on_click = prefs.placement.get("raise_on_click", 0) == 1
+        # Without hover focus, clicking is the only way to focus a window
+        self.click_focus = self.raise_on_click or not self.focus_on_hover
+        self.hover_delay = max(0, prefs.placement.get("hover_focus_delay", 100)) / 1000.0
+        self.hover_window = None
+        self.hover_time = None
+
+    def enter(self, window):
+        if self.focus_on_hover:
+            self.hover_window = window
+            self.hover_time = self.clock()
+
+    def leave(self, window):
+        if window == self.hover_window:
+            self.cancel()
+
+    def cancel(self):
+        self.hover_window = None
+        self.hover_time = None
+
+    def get_timeout(self):
+        # Seconds until the pending hover focus is due, or None if there is none
+        if self.hover_window is None:
+            return None
+        return max(0, self.hover_time + self.hover_delay - self.clock())
+
+    def take_due_window(self):
+        if self.hover_window is None or self.get_timeout() > 0:
+            return None
+        window = self.hover_window
+        self.cancel()
+        return window
+
+
+class WindowRecord(object):
+    '''
+    Everything the WM caches about one managed window. A record lives from
+    manage_window until the window is destroyed or unmanaged.
+    '''
+    __slots__ = (
+        "window", "window_type", "window_class", "title", "pid", "frame", "restore_geometry", "rule_actions"
+    )
+
+    def __init__(self, window, window_type=None):
+        self.window = window
+        self.window_type = window_type  # None until queried, X.NONE if the window has no type
+        self.window_class = None
+        self.title = None  # None until queried, refreshed on PropertyNotify
+        self.pid = None
+        self.frame = None  # Frame the window is reparented into, if titlebars are enabled
+        self.restore_geometry = None  # Geometry from before the window was maximized
+        self.rule_actions = None  # Merged actions of the window rules matching the window
+
+
+class Frame(object):
+    __slots__ = ("window", "drawn_title", "drawn_focused")
+
+    def __init__(self, window):
+        self.window = window
+        self.drawn_title = None  # What the titlebar currently shows, to skip redundant redraws
+        self.drawn_focused = None
+
+
+class FramePool(object):
+    '''
+    Frame windows for titlebars. Released frames are unmapped and kept for
+    the next managed window instead of being destroyed, so a burst of new
+    windows mostly reuses frames rather than creating them.
+    '''
+
+    def __init__(self, backend, capacity=16):
+        self.backend = backend
+        self.capacity = capacity
+        self.free_frames = []
+
+    def acquire(self, x, y, width, height, border_width, background_pixel, event_mask):
+        # Returns the frame and whether it was newly created
+        if len(self.free_frames) > 0:
+            return self.free_frames.pop(), False
+        window = self.backend.create_frame(x, y, width, height, border_width, background_pixel, event_mask)
+        return Frame(window), True
+
+    def release(self, frame):
+        # Returns whether the frame was destroyed rather than kept
+        frame.drawn_title = None
+        frame.drawn_focused = None
+        if len(self.free_frames) >= self.capacity:
+            self.backend.destroy_window(frame.window)
+            return True
+        self.backend.unmap_window(frame.window)
+        self.free_frames.append(frame)
+        return False
+
+
+class WindowShadow(object):
+    __slots__ = (
+        "window", "geometry", "border_width", "border_pixel",
+        "pending_configure", "pending_attributes", "in_flight"
+    )
+
+    def __init__(self, window):
+        self.window = window
+        self.geometry = {}  # x, y, width and height as last sent or reported
+        self.border_width = None
+        self.border_pixel = None
+        self.pending_configure = {}
+        self.pending_attributes = {}
+        self.in_flight = {}  # Configure key -> values sent whose ConfigureNotify has not arrived yet, oldest first
+
+
+class RequestShadow(object):
+    '''
+    Remembers the last border and geometry values the WM sent for each
+    window. Requests that would not change anything are dropped, and
+    the rest are queued and sent together by flush() once per loop iteration.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.shadows = {}  # Window ID -> WindowShadow
+        self.dirty = {}  # Window ID -> WindowShadow, in insertion order
+
+    def get_shadow(self, window):
+        shadow = self.shadows.get(window.id)
+        if shadow is None:
+            shadow = WindowShadow(window)
+            self.shadows[window.id] = shadow
+        return shadow
+
+    def forget(self, window):
+        self.forget_id(window.id)
+
+    def forget_id(self, window_id):
+        self.shadows.pop(window_id, None)
+        self.dirty.pop(window_id, None)
+
+    def configure(self, window, **values):
+        shadow = self.get_shadow(window)
+        for key, value in values.items():
+            if key == "border_width":
+                if shadow.border_width == value:
+                    continue
+                shadow.border_width = value
+            else:
+                if shadow.geometry.get(key) == value:
+                    continue
+                shadow.geometry[key] = value
+            shadow.pending_configure[key] = value
+            self.dirty[window.id] = shadow
+
+    def set_border_pixel(self, window, border_pixel):
+        shadow = self.get_shadow(window)
+        if shadow.border_pixel == border_pixel:
+            return
+        shadow.border_pixel = border_pixel
+        shadow.pending_attributes["border_pixel"] = border_pixel
+        self.dirty[window.id] = shadow
+
+    def set_geometry(self, window, **geometry):
+        # Record geometry the window already has, such as that of a window just created
+        self.get_shadow(window).geometry.update(geometry)
+
+    def get_geometry(self, window):
+        # Last known geometry of the window, or None if it is not fully known
+        shadow = self.shadows.get(window.id)
+        if shadow is None or len(shadow.geometry) < 4:
+            return None
+        return Geometry(**shadow.geometry)
+
+    def handle_configure_notify(self, ev):
+        # Clients may configure themselves, so trust what the server reports. Values the WM sent
+        # since then are newer though, so a value is only taken once no request for it is in flight.
+        shadow = self.shadows.get(ev.window.id)
+        if shadow is None:
+            return
+        reported = {"x": ev.x, "y": ev.y, "width": ev.width, "height": ev.height, "border_width": ev.border_width}
+        for key, value in reported.items():
+            if key in shadow.pending_configure:
+                continue
+            sent = shadow.in_flight.get(key)
+            if sent:
+                # A value that was never sent reflects the window before the requests were handled
+                if value not in sent:
+                    continue
+                del sent[:sent.index(value) + 1]
+                if len(sent) > 0:
+                    continue
+            if key == "border_width":
+                shadow.border_width = value
+            else:
+                shadow.geometry[key] = value
+
+    def flush(self):
+        if len(self.dirty) == 0:
+            return
+        for shadow in self.dirty.values():
+            if len(shadow.pending_configure) > 0:
+                self.backend.configure_window(shadow.window, **shadow.pending_configure)
+                for key, value in shadow.pending_configure.items():
+                    shadow.in_flight.setdefault(key, []).append(value)
+                shadow.pending_configure = {}
+            if len(shadow.pending_attributes) > 0:
+                self.backend.change_window_attributes(shadow.window, **shadow.pending_attributes)
+                shadow.pending_attributes = {}
+        self.dirty = {}
+
+
+class NetWMState(object):
+    '''
+    The WM's own copy of the _NET_WM_STATE of managed windows. A window's
+    states are read from the server the first time they are needed. After
+    that they only change here, and each changed window gets its property
+    written once by flush().
+    '''
+    REMOVE, ADD, TOGGLE = 0, 1, 2  # Actions of _NET_WM_STATE client messages
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.wm_state = backend.intern_atom("_NET_WM_STATE")
+        self.atoms = {}  # State name -> atom
+        self.states = {}  # Window ID -> list of state atoms
+        self.dirty = {}  # Window ID -> window, for windows whose property must be written
+
+    def get_atom(self, name):
+        atom = self.atoms.get(name)
+        if atom is None:
+            atom = self.backend.intern_atom(name)
+            self.atoms[name] = atom
+        return atom
+
+    def get_states(self, window):
+        states = self.states.get(window.id)
+        if states is None:
+            states = list(self.backend.get_property(window, self.wm_state, Xatom.ATOM) or [])
+            self.states[window.id] = states
+        return states
+
+    def has_state(self, window, name):
+        return self.get_atom(name) in self.get_states(window)
+
+    def change(self, window, action, *names):
+        states = self.get_states(window)
+        for name in names:
+            atom = self.get_atom(name)
+            present = atom in states
+            # A toggle flips each state on its own
+            atom_action = action
+            if atom_action == self.TOGGLE:
+                atom_action = self.REMOVE if present else self.ADD
+            if atom_action == self.ADD and not present:
+                states.append(atom)
+            elif atom_action == self.REMOVE and present:
+                states.remove(atom)
+            else:
+                continue
+            self.dirty[window.id] = window
+
+    def forget(self, window):
+        self.forget_id(window.id)
+
+    def forget_id(self, window_id):
+        self.states.pop(window_id, None)
+        self.dirty.pop(window_id, None)
+
+    def flush(self):
+        for window_id, window in self.dirty.items():
+            self.backend.change_property(window, self.wm_state, Xatom.ATOM, self.states[window_id])
+        self.dirty = {}
+
+
 '''
 Thanks to vulkd for creating xround
 https://github.com/vulkd/xround
 '''
 class DisplayCorners(object):
     def __init__(
-            self, ewmh, dpy, dpy_root, screen, display_dimensions,
-            wm_window_type, wm_window_types, wm_state, wm_window_status
+            self, dpy, dpy_root, screen, display_dimensions,
+            wm_window_type, wm_window_types, wm_state, wm_window_status,
+            stacking_order, resources
     ):
-        self.ewmh = ewmh
         self.dpy = dpy
         self.dpy_root = dpy_root
         self.screen = screen
         self.colormap = self.screen.default_colormap
         self.pixel_palette = PixelPalette(self.colormap)
-        self.system_font = load_font(self.dpy, FONT_NAME)
+        self.resources = resources
         self.display_dimensions = display_dimensions
 
         self.wm_window_type = wm_window_type
         self.wm_window_types = wm_window_types
         self.wm_state = wm_state
         self.wm_window_status = wm_window_status
+        self.stacking_order = stacking_order
 
         self.bg_size = 16
         self.corners = ['nw', 'ne', 'se', 'sw']
@@ -430,7 +1626,8 @@ class DisplayCorners(object):
 
     def draw_corner_pixmap(self, window, arc_start, arc_one, arc_two, pos_in_x=0, pos_in_y=0):
         corner_pm = window.create_pixmap(self.bg_size, self.bg_size, 1)
-        corner_gc = corner_pm.create_gc(foreground=1, background=1)
+        corner_gc = self.resources.get_gc(("corner_mask",), corner_pm, foreground=1, background=1)
+        corner_gc.change(foreground=1)
         corner_pm.fill_rectangle(corner_gc, 0, 0, self.bg_size, self.bg_size)
         corner_gc.change(foreground=0)
         corner_pm.fill_arc(corner_gc, pos_in_x, pos_in_y, self.bg_size, self.bg_size, arc_start, arc_one * arc_two)
@@ -444,19 +1641,27 @@ class DisplayCorners(object):
             self.has_run = True
         else:
             window.shape_mask(shape.SO.Union, shape.SK.Bounding, pos_x, pos_y, corner_pixmap)
-        return
+        # The shape is copied from the mask, so the mask is not needed afterwards
+        corner_pixmap.free()
 
     def draw(self):
         bg_pm = self.dpy_root.create_pixmap(self.bg_size, self.bg_size, self.screen.root_depth)
-        bg_gc = self.dpy_root.create_gc(foreground=self.screen.black_pixel, background=self.screen.black_pixel)
+        bg_gc = self.resources.get_gc(
+            ("corner_background",), self.dpy_root,
+            foreground=self.screen.black_pixel, background=self.screen.black_pixel
+        )
         bg_pm.fill_rectangle(bg_gc, 0, 0, self.bg_size, self.bg_size)
 
         self.display_corners = self.dpy_root.create_window(
-            0, 0, self.display_dimensions.width, self.display_dimensions.height, 0,
+            self.display_dimensions.x, self.display_dimensions.y,
+            self.display_dimensions.width, self.display_dimensions.height, 0,
             self.screen.root_depth,
             background_pixmap=bg_pm,
             event_mask=X.StructureNotifyMask
         )
+        self.stacking_order.add_overlay(self.display_corners.id)
+        # The server keeps its own reference to the background
+        bg_pm.free()
 
         sz = self.bg_size // 2
         if "nw" in self.corners:  # Check for the co-ord in corners array (that can be changed by user)
@@ -473,15 +1678,35 @@ class DisplayCorners(object):
         self.display_corners.change_property(self.wm_window_type, Xatom.ATOM, 32, [self.wm_window_types["dock"]],
                                              X.PropModeReplace)
 
-        self.ewmh.setWmState(self.display_corners, 1, "_NET_WM_DESKTOP")
-        self.ewmh.setWmState(self.display_corners, 1, "_NET_WM_STATE_SKIP_TASKBAR")
-        self.ewmh.setWmState(self.display_corners, 1, "_NET_WM_STATE_ABOVE")
+        # Not mapped yet, so the window sets its own state instead of asking the WM
+        self.display_corners.change_property(
+            self.wm_state,
+            Xatom.ATOM,
+            32,
+            [self.wm_window_status["skip_taskbar"], self.wm_window_status["above"]],
+            X.PropModeReplace
+        )
+        self.display_corners.change_property(self.wm_window_status["desktop"], Xatom.CARDINAL, 32, [0xFFFFFFFF], X.PropModeReplace)
 
         self.display_corners.map()
         self.update()
 
     def update(self):
+        # Only raise the overlay when something has been stacked above it
+        if not self.stacking_order.has_window_above(self.display_corners.id):
+            return
         self.display_corners.raise_window()
+        self.stacking_order.raise_window(self.display_corners.id)
+
+    def count_resources(self):
+        # Server-side resources owned by these corners
+        return 1 if self.display_corners is not None else 0
+
+    def stop(self):
+        if self.display_corners is not None:
+            self.stacking_order.remove_overlay(self.display_corners.id)
+            self.display_corners.destroy()
+            self.display_corners = None
 
 
 class Preferences(object):
@@ -493,12 +1718,18 @@ class Preferences(object):
             "auto_window_placement": 1,
             "auto_window_fit": 1,
             "auto_window_raise": 1,
-            "center_window_placement": 1
+            "center_window_placement": 1,
+            "outline_move_resize": 0,
+            "focus_on_hover": 1,
+            "hover_focus_delay": 100,
+            "raise_on_click": 0,
+            "remember_geometry": 0
         }
         self.deskbar = {
             "enabled": 1,
             "background_color": "white",
             "foreground_color": "black",
+            "items": ["clock", "memory"],
             "clock": {
                 "enabled": 1,
                 "show_day": 1,
@@ -513,9 +1744,12 @@ class Preferences(object):
             "window_border_width": 2,
             "active_window_border_color": "sienna",
             "inactive_window_border_color": "black",
-            "background_color": "#D2B48C"
+            "background_color": "#D2B48C",
+            "wallpaper": "",
+            "titlebars": 0
         }
 
+        self.rules = []
         self.categories = ["dev", "placement", "deskbar", "xround", "appearance"]
         self.read_config(ignore=False)
 
@@ -532,6 +1766,7 @@ class Preferences(object):
                         self.deskbar = user_prefs["deskbar"]
                         self.xround = user_prefs["xround"]
                         self.appearance = user_prefs["appearance"]
+                        self.rules = user_prefs.get("rules", [])
                     else:
                         print("Config file does not having matching keys!")
             else:
@@ -540,178 +1775,1224 @@ class Preferences(object):
             print("Ignoring config file... using defaults")
 
 
-class WindowManager(object):
-    def __init__(self, prefs, session_info):
-        self.prefs = prefs
-        self.session_info = session_info
-        self.ewmh = EWMH()
+class EventTraceWriter(object):
+    '''
+    Records the events seen by WindowManager.loop into a compact binary trace.
+    The header holds a JSON description of the recording session (root window,
+    screen size and key aliases), followed by one fixed-size record per event.
+    '''
+
+    # Trace slot -> event attributes that can fill it, in order of preference
+    FIELDS = (
+        ("time", ()),
+        ("type", ("type",)),
+        ("detail", ("detail", "place")),
+        ("mode", ("mode", "override")),
+        ("state", ("state", "count")),
+        ("window", ("window",)),
+        ("event", ("event",)),
+        ("child", ("child", "above_sibling", "parent", "atom", "client_type")),
+        ("x", ("root_x", "x")),
+        ("y", ("root_y", "y")),
+        ("width", ("width",)),
+        ("height", ("height",)),
+        ("border_width", ("border_width",)),
+        ("event_y", ("event_y",))
+    )
+    RECORD = struct.Struct("<dBBBHIIIhhHHHh")
+
+    def __init__(self, path):
+        self.path = path
+        self.trace_file = open(path, "wb")
+        self.start_time = time.monotonic()
+        self.record_count = 0
+
+    def write_header(self, dpy_root, display_dimensions, key_alias):
+        header = json.dumps({
+            "root": dpy_root.id,
+            "screen": [display_dimensions.width, display_dimensions.height],
+            "key_alias": key_alias
+        }).encode()
+        self.trace_file.write(TRACE_MAGIC + struct.pack("<BI", TRACE_VERSION, len(header)) + header)
+
+    def get_value(self, ev, attributes):
+        for attribute in attributes:
+            value = getattr(ev, attribute, None)
+            if value is not None:
+                return getattr(value, "id", value)
+        return 0
+
+    def record_batch(self, events):
+        # Events handled in one batch share their timestamp, which is how a replay finds the batches again
+        timestamp = time.monotonic() - self.start_time
+        for ev in events:
+            self.record(ev, timestamp)
+
+    def record(self, ev, timestamp=None):
+        values = [timestamp if timestamp is not None else time.monotonic() - self.start_time]
+        for slot, attributes in self.FIELDS[1:]:
+            values.append(self.get_value(ev, attributes))
+        try:
+            self.trace_file.write(self.RECORD.pack(*values))
+        except struct.error:
+            return  # Value out of range for the record, skip the event
+        self.record_count += 1
+        if self.record_count % 256 == 0:
+            self.trace_file.flush()
+
+    def close(self):
+        self.trace_file.close()
+
+
+class EventTraceReader(object):
+    def __init__(self, path):
+        with open(path, "rb") as trace_file:
+            data = trace_file.read()
+        if not data.startswith(TRACE_MAGIC):
+            raise ValueError("Not a BiscuitWM trace: " + path)
+        offset = len(TRACE_MAGIC)
+        version, header_length = struct.unpack_from("<BI", data, offset)
+        if version != TRACE_VERSION:
+            raise ValueError("Unsupported trace version: " + str(version))
+        offset += struct.calcsize("<BI")
+        self.header = json.loads(data[offset:offset + header_length].decode())
+        self.data = data
+        self.offset = offset + header_length
+
+    def events(self, backend):
+        # Yields (timestamp, FakeObject event) with window fields resolved through the backend
+        record = EventTraceWriter.RECORD
+        resource_attributes = ("window", "event", "child", "above_sibling", "parent")
+        for values in record.iter_unpack(self.data[self.offset:]):
+            ev = FakeObject()
+            for (slot, attributes), value in zip(EventTraceWriter.FIELDS[1:], values[1:]):
+                for attribute in attributes:
+                    if attribute in resource_attributes:
+                        # Like python-xlib, an empty resource field is X.NONE rather than a window
+                        setattr(ev, attribute, backend.get_window(value) if value != X.NONE else X.NONE)
+                    else:
+                        setattr(ev, attribute, value)
+            if ev.type == X.ClientMessage:
+                # Message data is not recorded, so messages are replayed empty
+                ev.data = (32, [0] * 5)
+            yield values[0], ev
+
+    def batches(self, backend):
+        # Yields (timestamp, events) for each batch handled by WindowManager.loop
+        batch_time, batch = None, []
+        for timestamp, ev in self.events(backend):
+            if len(batch) > 0 and timestamp != batch_time:
+                yield batch_time, batch
+                batch = []
+            batch_time = timestamp
+            batch.append(ev)
+        if len(batch) > 0:
+            yield batch_time, batch
+
+
+class XlibBackend(object):
+    '''
+    Display backend of the WM core, implemented with python-xlib. Every
+    request the core makes to the X server goes through one of these
+    methods; the deskbar and display corners draw through dpy directly.
+    '''
+
+    def __init__(self):
         self.dpy = display.Display()
         self.screen = self.dpy.screen()
-        self.dpy_root = self.screen.root
+        self.root = self.screen.root
         self.colormap = self.screen.default_colormap
-        self.pixel_palette = PixelPalette(self.colormap)
+        self.has_randr = self.dpy.has_extension("RANDR")
+        self.has_xinerama = self.dpy.has_extension("XINERAMA")
+        self.resources = ServerResources(self.dpy)
+        self.dead_window_ids = []  # Windows named by BadWindow or BadDrawable errors
+        # Errors for requests without a reply are reported here instead of raised
+        self.dpy.set_error_handler(self.handle_error)
+
+    # Connection
+
+    def handle_error(self, err, request=None):
+        if isinstance(err, (error.BadWindow, error.BadDrawable)):
+            self.dead_window_ids.append(err.resource_id)
+        else:
+            print("X error: %s" % err)
 
-        self.display_dimensions = self.get_display_geometry()
-        self.window_resize_options = [
-            "center",
-            "maximize",
-            "left",
-            "right",
-            "top",
-            "bottom"
-        ]
+    def take_dead_window_ids(self):
+        dead_window_ids, self.dead_window_ids = self.dead_window_ids, []
+        return dead_window_ids
 
-        self.managed_windows = []
-        self.exposed_windows = []
-        self.last_raised_window = None
-        self.active_window_title = self.session_info.session_name
-        self.window_order = -1
+    def next_event(self):
+        return self.dpy.next_event()
 
-        self.key_alias = {}
+    def pending_events(self):
+        return self.dpy.pending_events()
 
-        self.start = None
-        self.attr = None
+    def wait_for_event(self, timeout):
+        # Whether an event arrived within timeout seconds
+        readable, writable, exceptional = select.select([self.dpy], [], [], timeout)
+        return len(readable) > 0 or self.dpy.pending_events() > 0
 
-        self.wm_window_type = self.dpy.intern_atom('_NET_WM_WINDOW_TYPE')
-        self.wm_state = self.dpy.intern_atom('_NET_WM_STATE')
-        self.wm_window_types = {
-            "dock": self.dpy.intern_atom('_NET_WM_WINDOW_TYPE_DOCK'),
-            "normal": self.dpy.intern_atom('_NET_WM_WINDOW_TYPE_NORMAL'),
-            "dialog": self.dpy.intern_atom('_NET_WM_WINDOW_TYPE_DIALOG'),
-            "utility": self.dpy.intern_atom('_NET_WM_WINDOW_TYPE_UTILITY'),
-            "toolbar": self.dpy.intern_atom('_NET_WM_WINDOW_TYPE_TOOLBAR'),
-            "menu": self.dpy.intern_atom('_NET_WM_WINDOW_TYPE_MENU'),
-            "splash": self.dpy.intern_atom('_NET_WM_WINDOW_TYPE_SPLASH')
-        }
-        self.wm_window_status = {
-            "active": self.dpy.intern_atom('_NET_ACTIVE_WINDOW'),
-            "desktop": self.dpy.intern_atom('_NET_WM_DESKTOP'),
-            "above": self.dpy.intern_atom('_NET_WM_STATE_ABOVE'),
-            "skip_taskbar": self.dpy.intern_atom('_NET_WM_STATE_SKIP_TASKBAR'),
-            "maximize_vertical": self.dpy.intern_atom('_NET_WM_STATE_MAXIMIZED_VERT'),
-            "maximize_horizontal": self.dpy.intern_atom('_NET_WM_STATE_MAXIMIZED_HORIZ')
-        }
+    def flush(self):
+        self.dpy.flush()
 
-        self.wm_window_cyclical = [
-            self.wm_window_types["normal"],
-            self.wm_window_types["dialog"],
-            self.wm_window_types["utility"],
-            self.wm_window_types["toolbar"]
-        ]
+    def send_wakeup(self, atom):
+        # Sent from another thread, so a main loop blocked on the connection gets an event
+        ev = event.ClientMessage(window=self.root, client_type=atom, data=(32, [0] * 5))
+        self.root.send_event(ev, event_mask=X.SubstructureNotifyMask)
+        self.dpy.flush()
 
-        self.deskbar = None
-        self.display_corners = None
+    def close(self):
+        self.dpy.close()
 
-        self.update_active_window_title_rt = RepeatedTimer(interval=1, function=self.update_active_window_title)
-        self.update_active_window_title_rt.stop()
+    def intern_atom(self, name):
+        return self.dpy.intern_atom(name)
 
-        self.set_cursor(self.dpy_root)
+    def keysym_to_keycode(self, keysym):
+        return self.dpy.keysym_to_keycode(keysym)
 
-    ### QUERY METHODS
+    def keycode_to_keysym(self, keycode, index):
+        return self.dpy.keycode_to_keysym(keycode, index)
 
-    def get_display_geometry(self):
-        return self.dpy_root.get_geometry()
+    # Root window
 
-    def window_list(self):
-        return self.dpy_root.query_tree().children
+    def get_root_geometry(self):
+        return self.root.get_geometry()
 
-    def is_managed_window(self, window):
-        return window in self.managed_windows
+    def query_children(self):
+        return self.root.query_tree().children
 
-    def is_alive_window(self, window):
-        windows = self.dpy_root.query_tree().children
-        return window in windows
+    def query_pointer(self):
+        pointer = self.root.query_pointer()
+        return pointer.root_x, pointer.root_y
 
-    def is_dock(self, window):
-        result = None
-        try:
-            result = window.get_full_property(self.wm_window_type, Xatom.ATOM)
-        except error.BadWindow or RuntimeError:
-            print("Failed to detect if window is dock")
-            pass
-        if result is not None and result.value[0] == self.wm_window_types["dock"]:
-            return True
-        return False
+    def query_modifiers(self):
+        # Modifier keys and buttons held right now
+        return self.root.query_pointer().mask
 
-    def is_popup_window(self, window):
-        result = None
-        try:
-            result = window.get_full_property(self.wm_window_type, Xatom.ATOM)
-        except error.BadWindow or RuntimeError:
-            print("Failed to detect if window is dock")
-            pass
-        if result is not None and (
-                result.value[0] == self.wm_window_types["menu"] or result.value[0] == self.wm_window_types["splash"]):
-            return True
-        return False
+    def select_root_input(self, event_mask):
+        self.root.change_attributes(event_mask=event_mask)
 
-    def is_cyclical_window(self, window):
-        result = None
-        try:
-            result = window.get_full_property(self.wm_window_type, Xatom.ATOM)
-        except error.BadWindow or RuntimeError:
-            print("Failed to detect if window is dock")
-            pass
-        if result is not None and result.value[0] in self.wm_window_cyclical:
-            return True
-        return False
+    def grab_key(self, keycode, modifiers):
+        self.root.grab_key(keycode, modifiers, 1, X.GrabModeAsync, X.GrabModeAsync)
 
-    def is_active(self, atom):
-        if atom == self.wm_window_status["active"]:
-            return True
-        return False
+    def grab_button(self, button, modifiers, event_mask):
+        self.root.grab_button(button, modifiers, 1, event_mask, X.GrabModeAsync, X.GrabModeAsync, X.NONE, X.NONE)
 
-    def get_active_window(self):
-        window = None
-        try:
-            window = self.dpy_root.get_full_property(self.wm_window_status["active"], Xatom.ATOM)
-        except:
-            print("Failed to get active window")
-            pass
-        return window
+    def grab_click(self, window):
+        # Clicks on the window freeze the pointer until replay_pointer passes them on to the client
+        window.grab_button(X.AnyButton, X.AnyModifier, True, X.ButtonPressMask,
+                           X.GrabModeSync, X.GrabModeAsync, X.NONE, X.NONE)
 
-    def get_window_class(self, window):
-        try:
-            cmd, cls = window.get_wm_class()
-        except:
-            return ''
-        if cls is not None:
-            return cls
-        else:
-            return ''
+    def ungrab_click(self, window):
+        window.ungrab_button(X.AnyButton, X.AnyModifier)
 
-    def get_window_geometry(self, window):
-        try:
-            return window.get_geometry()
-        except:
+    def replay_pointer(self):
+        self.dpy.allow_events(X.ReplayPointer, X.CurrentTime)
+
+    def grab_keyboard(self):
+        # Whether the grab succeeded, it fails if another client holds the keyboard
+        reply = self.root.grab_keyboard(False, X.GrabModeAsync, X.GrabModeAsync, X.CurrentTime)
+        return reply.status == X.GrabSuccess
+
+    def ungrab_keyboard(self):
+        self.dpy.ungrab_keyboard(X.CurrentTime)
+
+    def create_frame(self, x, y, width, height, border_width, background_pixel, event_mask):
+        return self.root.create_window(
+            x, y, width, height, border_width,
+            self.screen.root_depth,
+            background_pixel=background_pixel,
+            event_mask=event_mask
+        )
+
+    def reparent_window(self, window, parent, x, y):
+        window.reparent(parent, x, y)
+
+    def add_to_save_set(self, window):
+        # Windows in the save-set go back to the root if the WM exits
+        window.change_save_set(X.SetModeInsert)
+
+    def remove_from_save_set(self, window):
+        window.change_save_set(X.SetModeDelete)
+
+    def unmap_window(self, window):
+        window.unmap()
+
+    def render_titlebar_background(self, pixmap, width, height, background_pixel, foreground_pixel):
+        gc = self.resources.get_gc(("titlebar_fill",), self.root)
+        gc.change(foreground=background_pixel)
+        pixmap.fill_rectangle(gc, 0, 0, width, height)
+        gc.change(foreground=foreground_pixel)
+        pixmap.fill_rectangle(gc, 0, height - 1, width, 1)
+
+    def get_image_format(self):
+        # Raw pixel layout for put_image on the root, or None unless pixels are 32-bit true colour
+        if self.screen.root_depth != 24:
             return None
+        for pixmap_format in self.dpy.info.pixmap_formats:
+            if pixmap_format.depth == self.screen.root_depth and pixmap_format.bits_per_pixel == 32:
+                return "BGRX" if self.dpy.info.image_byte_order == X.LSBFirst else "XRGB"
+        return None
+
+    def create_image_pixmap(self, key, width, height, data):
+        def render(pixmap):
+            # Upload in strips of rows, each within the maximum request size
+            gc = self.resources.get_gc(("image",), self.root)
+            stride = width * 4
+            rows = max(1, (self.dpy.info.max_request_length * 4 - 64) // stride)
+            for y in range(0, height, rows):
+                strip_height = min(rows, height - y)
+                pixmap.put_image(
+                    gc, 0, y, width, strip_height, X.ZPixmap, self.screen.root_depth, 0,
+                    data[y * stride:(y + strip_height) * stride]
+                )
+        return self.resources.get_pixmap(key, self.root, width, height, self.screen.root_depth, render)
+
+    def free_pixmap(self, key):
+        self.resources.free_pixmap(key)
+
+    def set_root_background(self, pixel=None, pixmap=None):
+        # _XROOTPMAP_ID tells other clients, such as terminals with fake transparency, what the wallpaper is
+        root_pixmap_atoms = [self.intern_atom("_XROOTPMAP_ID"), self.intern_atom("ESETROOT_PMAP_ID")]
+        if pixmap is not None:
+            self.root.change_attributes(background_pixmap=pixmap)
+            for atom in root_pixmap_atoms:
+                self.root.change_property(atom, Xatom.PIXMAP, 32, [pixmap.id], X.PropModeReplace)
+        else:
+            self.root.change_attributes(background_pixel=pixel)
+            for atom in root_pixmap_atoms:
+                self.root.delete_property(atom)
+        self.root.clear_area()
+
+    def forget_root_pixmap(self):
+        # The root keeps showing the pixmap after the WM disconnects, but its ID is freed with the connection
+        for atom_name in ("_XROOTPMAP_ID", "ESETROOT_PMAP_ID"):
+            self.root.delete_property(self.intern_atom(atom_name))
+
+    def draw_titlebar(self, window, width, height, background_pixel, foreground_pixel, title):
+        # The background of each style is rendered once, as wide as the screen, and copied on redraw
+        background_width = self.screen.width_in_pixels
+        background = self.resources.get_pixmap(
+            ("titlebar", background_pixel, foreground_pixel, height),
+            self.root, background_width, height, self.screen.root_depth,
+            lambda pixmap: self.render_titlebar_background(
+                pixmap, background_width, height, background_pixel, foreground_pixel
+            )
+        )
+        gc = self.resources.get_gc(
+            ("titlebar_text", background_pixel, foreground_pixel), self.root,
+            font=self.resources.get_font(FONT_NAME),
+            foreground=foreground_pixel,
+            background=background_pixel
+        )
+        window.copy_area(gc, background, 0, 0, min(width, background_width), height, 0, 0)
+        window.draw_text(gc, 8, height - 5, title.encode('utf-8'))
+
+    def grab_server(self):
+        self.dpy.grab_server()
+
+    def ungrab_server(self):
+        self.dpy.ungrab_server()
+
+    def draw_outline(self, x, y, width, height, line_width):
+        # Drawing the same outline twice erases it, as the GC XORs onto the root and every window on it
+        gc = self.resources.get_gc(
+            ("outline", line_width), self.root,
+            function=X.GXxor,
+            foreground=self.screen.black_pixel ^ self.screen.white_pixel,
+            subwindow_mode=X.IncludeInferiors,
+            line_width=line_width
+        )
+        self.root.rectangle(gc, x, y, width, height)
 
-    def get_maximum_available_geometry(self):
-        window_width = self.display_dimensions.width
-        window_height = self.display_dimensions.height
-        if self.deskbar is not None:
-            window_height -= self.deskbar.real_height
-        return window_width, window_height, self.deskbar is not None
+    # Monitors
+
+    def query_monitors(self):
+        try:
+            if self.has_randr:
+                monitors = self.query_randr_monitors()
+                if len(monitors) > 0:
+                    return monitors
+            if self.has_xinerama:
+                return self.query_xinerama_monitors()
+        except error.XError:
+            print("Failed to query monitor layout")
+        return []
+
+    def query_randr_monitors(self):
+        resources = self.root.xrandr_get_screen_resources_current()
+        try:
+            primary_output = self.root.xrandr_get_output_primary().output
+        except error.XError:
+            primary_output = None
+        monitors = []
+        for crtc in resources.crtcs:
+            info = self.dpy.xrandr_get_crtc_info(crtc, resources.config_timestamp)
+            if info.width == 0 or info.height == 0 or len(info.outputs) == 0:
+                continue
+            monitor = Geometry(info.x, info.y, info.width, info.height)
+            if monitor in monitors:
+                continue  # Cloned outputs share one monitor
+            if primary_output in info.outputs:
+                monitors.insert(0, monitor)
+            else:
+                monitors.append(monitor)
+        return monitors
+
+    def query_xinerama_monitors(self):
+        if not self.dpy.xinerama_is_active().state:
+            return []
+        monitors = []
+        for screen in self.dpy.xinerama_query_screens().screens:
+            monitor = Geometry(screen.x, screen.y, screen.width, screen.height)
+            if monitor not in monitors:
+                monitors.append(monitor)
+        return monitors
+
+    def select_screen_change_input(self):
+        if self.has_randr:
+            self.root.xrandr_select_input(randr.RRScreenChangeNotifyMask)
+
+    def is_screen_change_event(self, ev):
+        return isinstance(ev, randr.ScreenChangeNotify)
+
+    # Window queries
+
+    def get_window(self, window_id):
+        return self.dpy.create_resource_object("window", window_id)
+
+    def get_property(self, window, atom, property_type):
+        try:
+            result = window.get_full_property(atom, property_type)
+        except error.XError as err:
+            self.handle_error(err)
+            return None
+        if result is None or len(result.value) == 0:
+            return None
+        return result.value
+
+    def take_text_property(self, window, atom):
+        # Read and delete the property with one request
+        try:
+            result = window.get_property(atom, Xatom.STRING, 0, 1 << 22, delete=True)
+        except error.XError as err:
+            self.handle_error(err)
+            return None
+        if result is None or len(result.value) == 0:
+            return None
+        return result.value.decode("latin-1")
+
+    def get_window_geometry(self, window):
+        try:
+            return window.get_geometry()
+        except error.XError as err:
+            self.handle_error(err)
+            return None
 
     def get_window_attributes(self, window):
         try:
             return window.get_attributes()
-        except:
+        except error.XError as err:
+            self.handle_error(err)
+            return None
+
+    def get_window_title(self, window):
+        try:
+            return window.get_wm_name()
+        except error.XError as err:
+            self.handle_error(err)
+            return None
+
+    def get_window_class(self, window):
+        try:
+            wm_class = window.get_wm_class()
+        except error.XError as err:
+            self.handle_error(err)
+            return None
+        if wm_class is None:
+            return None
+        return wm_class[1]
+
+    # Window requests
+
+    def map_window(self, window):
+        window.map()
+
+    def destroy_window(self, window):
+        window.destroy()
+
+    def raise_window(self, window):
+        window.raise_window()
+
+    def set_input_focus(self, window):
+        window.set_input_focus(X.RevertToParent, 0)
+
+    def select_input(self, window, event_mask):
+        window.change_attributes(event_mask=event_mask)
+
+    def configure_window(self, window, **values):
+        window.configure(**values)
+
+    def change_window_attributes(self, window, **attributes):
+        window.change_attributes(None, **attributes)
+
+    def change_property(self, window, atom, property_type, values):
+        window.change_property(atom, property_type, 32, values, X.PropModeReplace)
+
+    def set_text_property(self, window, atom, text):
+        window.change_property(atom, Xatom.STRING, 8, text.encode("latin-1"), X.PropModeReplace)
+
+    def set_cursor(self, window):
+        window.change_attributes(cursor=self.resources.get_cursor())
+
+    def count_resources(self):
+        return self.resources.counts()
+
+    def free_resources(self):
+        self.resources.free()
+
+
+class FakeObject(object):
+    # Attribute bag standing in for Xlib events and replies
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FakeWindow(object):
+    __slots__ = ("id",)
+
+    def __init__(self, window_id):
+        self.id = window_id
+
+    def __eq__(self, other):
+        return isinstance(other, FakeWindow) and self.id == other.id
+
+    def __hash__(self):
+        return self.id
+
+    def __repr__(self):
+        return "FakeWindow(0x{:x})".format(self.id)
+
+
+class FakeWindowState(object):
+    __slots__ = ("geometry", "override_redirect", "mapped", "properties", "title", "wm_class")
+
+    def __init__(self, geometry, override_redirect=False, mapped=True, title=None, wm_class=None):
+        self.geometry = geometry  # [x, y, width, height, border_width]
+        self.override_redirect = override_redirect
+        self.mapped = mapped
+        self.properties = {}  # Atom -> list of values
+        self.title = title
+        self.wm_class = wm_class
+
+
+class FakeColormap(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def alloc_named_color(self, name):
+        self.backend.count_request("alloc_named_color", round_trip=True)
+        # The palette only asks for #rrggbb colours, each of which gets its own pixel
+        return FakeObject(pixel=int(name[1:], 16))
+
+
+class FakeBackend(object):
+    '''
+    In-memory display backend with no X server behind it. It keeps just
+    enough state to answer the core's queries, and counts every request
+    as well as the round trips (requests that wait for a reply), which
+    makes it suitable for benchmarking, fuzzing and replaying traces.
+    '''
+
+    def __init__(self, width=1920, height=1080, root_id=0x100, key_alias=None):
+        self.dpy = None
+        self.screen = None
+        self.colormap = FakeColormap(self)
+        self.requests = {}  # Request name -> count
+        self.round_trips = 0
+        self.resources = None
+        self.cursors = set()  # Cursor font glyphs created so far
+        self.titlebar_backgrounds = set()  # Titlebar styles rendered so far
+        self.image_pixmaps = set()  # Keys of pixmaps made by create_image_pixmap
+        self.root_background = None
+        self.text_properties = {}  # (Window ID, atom) -> text
+        self.atoms = {}
+        self.windows = {}  # Window ID -> FakeWindowState
+        self.handles = {}  # Window ID -> FakeWindow
+        self.stacking = []  # Top-level window IDs, bottom to top
+        self.destroyed = set()  # Window IDs that no longer exist on the fake server
+        self.dead_window_ids = []
+        self.focus = None
+        self.pointer = (0, 0)
+        self.modifiers = X.Mod1Mask  # Alt is held, so window switcher sessions last until its release
+        self.events = []
+        self.next_window_id = 0x400000
+        self.root = self.get_window(root_id)
+        self.root_geometry = [0, 0, width, height, 0]
+        self.keycodes = {}  # Keysym -> keycode
+        for name, keycode in (key_alias or {}).items():
+            self.keycodes[XK.string_to_keysym(name)] = keycode
+
+    def count_request(self, name, round_trip=False):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if round_trip:
+            self.round_trips += 1
+
+    def reset_counts(self):
+        self.requests = {}
+        self.round_trips = 0
+
+    def get_window(self, window_id):
+        handle = self.handles.get(window_id)
+        if handle is None:
+            handle = FakeWindow(window_id)
+            self.handles[window_id] = handle
+        return handle
+
+    def get_state(self, window):
+        state = self.windows.get(window.id)
+        if state is None and window != self.root:
+            # Windows only seen in events are normal application windows
+            state = FakeWindowState([0, 0, 640, 480, 0])
+            state.properties[self.intern_atom_locally("_NET_WM_WINDOW_TYPE")] = [
+                self.intern_atom_locally("_NET_WM_WINDOW_TYPE_NORMAL")
+            ]
+            self.windows[window.id] = state
+            self.stacking.append(window.id)
+        return state
+
+    def add_window(self, x=0, y=0, width=640, height=480, window_type="normal", title=None, wm_class=None,
+                   override_redirect=False, mapped=True, window_id=None):
+        if window_id is None:
+            self.next_window_id += 1
+            window_id = self.next_window_id
+        window = self.get_window(window_id)
+        self.destroyed.discard(window_id)
+        state = FakeWindowState([x, y, width, height, 0], override_redirect, mapped, title, wm_class)
+        if window_type is not None:
+            state.properties[self.intern_atom_locally("_NET_WM_WINDOW_TYPE")] = [
+                self.intern_atom_locally("_NET_WM_WINDOW_TYPE_" + window_type.upper())
+            ]
+        self.windows[window_id] = state
+        self.stacking.append(window_id)
+        return window
+
+    def make_event(self, event_type, **fields):
+        ev = FakeObject(type=event_type, event=self.root, child=self.root, root_x=0, root_y=0, event_y=0,
+                        detail=0, state=0, mode=X.NotifyNormal, count=0)
+        ev.__dict__.update(fields)
+        return ev
+
+    def apply_event(self, ev):
+        # Keep window state in line with notify events coming from a trace
+        if ev.type == X.CreateNotify:
+            self.destroyed.discard(ev.window.id)  # The server may reuse IDs
+            state = self.get_state(ev.window)
+            state.geometry = [ev.x, ev.y, ev.width, ev.height, ev.border_width]
+        elif ev.type == X.ConfigureNotify:
+            self.get_state(ev.window).geometry = [ev.x, ev.y, ev.width, ev.height, ev.border_width]
+        elif ev.type == X.DestroyNotify:
+            self.forget_state(ev.window)
+
+    def forget_state(self, window):
+        self.windows.pop(window.id, None)
+        self.destroyed.add(window.id)
+        if window.id in self.stacking:
+            self.stacking.remove(window.id)
+
+    def is_destroyed(self, window):
+        # Requests on a destroyed window fail the way the X server would report them
+        if window.id in self.destroyed:
+            self.dead_window_ids.append(window.id)
+            return True
+        return False
+
+    # Connection
+
+    def take_dead_window_ids(self):
+        dead_window_ids, self.dead_window_ids = self.dead_window_ids, []
+        return dead_window_ids
+
+    def next_event(self):
+        self.count_request("next_event")
+        return self.events.pop(0)
+
+    def pending_events(self):
+        return len(self.events)
+
+    def wait_for_event(self, timeout):
+        return len(self.events) > 0
+
+    def flush(self):
+        self.count_request("flush")
+
+    def send_wakeup(self, atom):
+        self.count_request("send_event")
+        self.events.append(self.make_event(X.ClientMessage, window=self.root, client_type=atom, data=(32, [0] * 5)))
+
+    def close(self):
+        pass
+
+    def intern_atom_locally(self, name):
+        if name not in self.atoms:
+            self.atoms[name] = len(self.atoms) + 1
+        return self.atoms[name]
+
+    def intern_atom(self, name):
+        self.count_request("intern_atom", round_trip=True)
+        return self.intern_atom_locally(name)
+
+    def keysym_to_keycode(self, keysym):
+        return self.keycodes.get(keysym, 0)
+
+    def keycode_to_keysym(self, keycode, index):
+        for keysym, value in self.keycodes.items():
+            if value == keycode:
+                return keysym
+        return 0
+
+    # Root window
+
+    def get_root_geometry(self):
+        self.count_request("get_geometry", round_trip=True)
+        x, y, width, height, border_width = self.root_geometry
+        return FakeObject(x=x, y=y, width=width, height=height, border_width=border_width)
+
+    def query_children(self):
+        self.count_request("query_tree", round_trip=True)
+        return [self.get_window(window_id) for window_id in self.stacking]
+
+    def query_pointer(self):
+        self.count_request("query_pointer", round_trip=True)
+        return self.pointer
+
+    def query_modifiers(self):
+        self.count_request("query_pointer", round_trip=True)
+        return self.modifiers
+
+    def select_root_input(self, event_mask):
+        self.count_request("change_attributes")
+
+    def grab_key(self, keycode, modifiers):
+        self.count_request("grab_key")
+
+    def grab_button(self, button, modifiers, event_mask):
+        self.count_request("grab_button")
+
+    def grab_click(self, window):
+        self.count_request("grab_button")
+
+    def ungrab_click(self, window):
+        self.count_request("ungrab_button")
+
+    def replay_pointer(self):
+        self.count_request("allow_events")
+
+    def grab_keyboard(self):
+        self.count_request("grab_keyboard", round_trip=True)
+        return True
+
+    def ungrab_keyboard(self):
+        self.count_request("ungrab_keyboard")
+
+    def create_frame(self, x, y, width, height, border_width, background_pixel, event_mask):
+        self.count_request("create_window")
+        window = self.add_window(x, y, width, height, window_type=None, mapped=False)
+        self.get_state(window).geometry[4] = border_width
+        return window
+
+    def reparent_window(self, window, parent, x, y):
+        self.count_request("reparent_window")
+        if self.is_destroyed(window):
+            return
+        if window.id in self.stacking:
+            self.stacking.remove(window.id)
+        if parent == self.root:
+            self.stacking.append(window.id)
+        geometry = self.get_state(window).geometry
+        geometry[0], geometry[1] = x, y
+
+    def add_to_save_set(self, window):
+        self.count_request("change_save_set")
+
+    def remove_from_save_set(self, window):
+        self.count_request("change_save_set")
+
+    def unmap_window(self, window):
+        self.count_request("unmap_window")
+        if not self.is_destroyed(window):
+            self.get_state(window).mapped = False
+
+    def get_image_format(self):
+        return "BGRX"
+
+    def create_image_pixmap(self, key, width, height, data):
+        if key not in self.image_pixmaps:
+            self.image_pixmaps.add(key)
+            self.count_request("create_pixmap")
+            for y in range(0, height, 64):
+                self.count_request("put_image")
+        return FakeObject(id=key)
+
+    def free_pixmap(self, key):
+        if key in self.image_pixmaps:
+            self.image_pixmaps.remove(key)
+            self.count_request("free_pixmap")
+
+    def set_root_background(self, pixel=None, pixmap=None):
+        self.count_request("change_attributes")
+        for atom_name in ("_XROOTPMAP_ID", "ESETROOT_PMAP_ID"):
+            self.count_request("change_property" if pixmap is not None else "delete_property")
+        self.count_request("clear_area")
+        self.root_background = pixmap if pixmap is not None else pixel
+
+    def forget_root_pixmap(self):
+        for atom_name in ("_XROOTPMAP_ID", "ESETROOT_PMAP_ID"):
+            self.count_request("delete_property")
+
+    def draw_titlebar(self, window, width, height, background_pixel, foreground_pixel, title):
+        self.titlebar_backgrounds.add((background_pixel, foreground_pixel, height))
+        self.count_request("copy_area")
+        self.count_request("poly_text8")
+
+    def grab_server(self):
+        self.count_request("grab_server")
+
+    def ungrab_server(self):
+        self.count_request("ungrab_server")
+
+    def draw_outline(self, x, y, width, height, line_width):
+        self.count_request("poly_rectangle")
+
+    # Monitors
+
+    def query_monitors(self):
+        return []
+
+    def select_screen_change_input(self):
+        pass
+
+    def is_screen_change_event(self, ev):
+        return False
+
+    # Window queries
+
+    def get_property(self, window, atom, property_type):
+        self.count_request("get_property", round_trip=True)
+        if self.is_destroyed(window):
+            return None
+        state = self.get_state(window)
+        if state is None:
+            return None
+        return state.properties.get(atom)
+
+    def take_text_property(self, window, atom):
+        self.count_request("get_property", round_trip=True)
+        return self.text_properties.pop((window.id, atom), None)
+
+    def get_window_geometry(self, window):
+        self.count_request("get_geometry", round_trip=True)
+        if window == self.root:
+            return self.get_root_geometry()
+        if self.is_destroyed(window):
+            return None
+        x, y, width, height, border_width = self.get_state(window).geometry
+        return FakeObject(x=x, y=y, width=width, height=height, border_width=border_width)
+
+    def get_window_attributes(self, window):
+        self.count_request("get_window_attributes", round_trip=True)
+        if self.is_destroyed(window):
+            return None
+        state = self.get_state(window)
+        return FakeObject(
+            override_redirect=state.override_redirect,
+            map_state=X.IsViewable if state.mapped else X.IsUnmapped
+        )
+
+    def get_window_title(self, window):
+        self.count_request("get_property", round_trip=True)
+        if self.is_destroyed(window):
+            return None
+        return self.get_state(window).title
+
+    def get_window_class(self, window):
+        self.count_request("get_property", round_trip=True)
+        if self.is_destroyed(window):
+            return None
+        return self.get_state(window).wm_class
+
+    # Window requests
+
+    def map_window(self, window):
+        self.count_request("map_window")
+        if not self.is_destroyed(window):
+            self.get_state(window).mapped = True
+
+    def destroy_window(self, window):
+        self.count_request("destroy_window")
+        if not self.is_destroyed(window):
+            self.forget_state(window)
+
+    def raise_window(self, window):
+        self.count_request("configure_window")
+        if not self.is_destroyed(window) and window.id in self.stacking:
+            self.stacking.remove(window.id)
+            self.stacking.append(window.id)
+
+    def set_input_focus(self, window):
+        self.count_request("set_input_focus")
+        if not self.is_destroyed(window):
+            self.focus = window
+
+    def select_input(self, window, event_mask):
+        self.count_request("change_attributes")
+        self.is_destroyed(window)
+
+    def configure_window(self, window, **values):
+        self.count_request("configure_window")
+        if self.is_destroyed(window):
+            return
+        geometry = self.get_state(window).geometry
+        for index, key in enumerate(("x", "y", "width", "height", "border_width")):
+            if key in values:
+                geometry[index] = values[key]
+
+    def change_window_attributes(self, window, **attributes):
+        self.count_request("change_attributes")
+        self.is_destroyed(window)
+
+    def change_property(self, window, atom, property_type, values):
+        self.count_request("change_property")
+        state = None if self.is_destroyed(window) else self.get_state(window)
+        if state is not None:
+            state.properties[atom] = list(values)
+
+    def set_text_property(self, window, atom, text):
+        self.count_request("change_property")
+        if not self.is_destroyed(window):
+            self.text_properties[(window.id, atom)] = text
+
+    def set_cursor(self, window):
+        if Xcursorfont.left_ptr not in self.cursors:
+            self.cursors.add(Xcursorfont.left_ptr)
+            self.count_request("open_font")
+            self.count_request("create_glyph_cursor")
+        self.count_request("change_attributes")
+
+    def count_resources(self):
+        return {
+            "font": len(self.cursors), "cursor": len(self.cursors), "gc": 0,
+            "pixmap": len(self.titlebar_backgrounds) + len(self.image_pixmaps)
+        }
+
+    def free_resources(self):
+        self.cursors = set()
+        self.titlebar_backgrounds = set()
+        self.image_pixmaps = set()
+
+
+class TraceReplayer(object):
+    '''
+    Feeds a recorded trace back through the handlers of a WindowManager
+    running against a FakeBackend, and reports how long they took.
+    '''
+
+    def __init__(self, path, prefs, session_info):
+        self.reader = EventTraceReader(path)
+        width, height = self.reader.header["screen"]
+        self.backend = FakeBackend(
+            width, height, root_id=self.reader.header["root"], key_alias=self.reader.header["key_alias"]
+        )
+        # Only the window management handlers are replayed
+        prefs.dev["debug"] = 0
+        prefs.deskbar["enabled"] = 0
+        prefs.xround["enabled"] = 0
+        self.wm = WindowManager(prefs, session_info, backend=self.backend)
+        self.wm.process_supervisor.dry_run = True
+        self.wm.command_index.history_path = None
+        if self.wm.geometry_store is not None:
+            self.wm.geometry_store.path = None
+        self.wm.set_key_aliases()
+        self.trace_time = 0
+        self.wm.focus_policy.clock = lambda: self.trace_time
+        self.timings = {}  # Event type, or "flush" -> list of durations
+        self.wm.handler_timings = self.timings
+        self.event_count = 0
+
+    def run(self):
+        total_start = time.perf_counter()
+        self.backend.reset_counts()
+        for timestamp, events in self.reader.batches(self.backend):
+            for ev in events:
+                self.backend.apply_event(ev)
+            self.event_count += len(events)
+            try:
+                # A hover focus that came due before this batch was applied while waiting for it
+                self.trace_time = timestamp
+                self.wm.apply_hover_focus()
+                self.wm.handle_events(events)
+            except SystemExit:
+                print("Trace ended the session at %.3fs" % timestamp)
+                break
+        return time.perf_counter() - total_start
+
+    def report(self, elapsed):
+        event_names = {value: name for name, value in vars(X).items() if name.endswith("Notify") or name in (
+            "KeyPress", "KeyRelease", "ButtonPress", "ButtonRelease", "FocusIn", "FocusOut", "Expose"
+        )}
+        handled_count = sum(len(durations) for event_type, durations in self.timings.items() if event_type != "flush")
+        print("%-20s %8s %10s %10s %10s" % ("event", "count", "total ms", "mean us", "max us"))
+        for event_type, durations in sorted(self.timings.items(), key=lambda item: -sum(item[1])):
+            print("%-20s %8d %10.2f %10.1f %10.1f" % (
+                event_names.get(event_type, str(event_type)), len(durations),
+                sum(durations) * 1e3, sum(durations) / len(durations) * 1e6, max(durations) * 1e6
+            ))
+        event_count = self.event_count
+        print("%d events in %.3fs (%.0f events/s), %d dropped by coalescing, %d flushes" % (
+            event_count, elapsed, event_count / elapsed if elapsed > 0 else 0,
+            event_count - handled_count, len(self.timings.get("flush", []))
+        ))
+        print("Requests: " + ", ".join(
+            "%s=%d" % (name, count) for name, count in sorted(self.backend.requests.items(), key=lambda item: -item[1])
+        ))
+        print("Round trips: %d (%.2f per event)" % (
+            self.backend.round_trips, self.backend.round_trips / event_count if event_count > 0 else 0
+        ))
+
+
+class WindowManager(object):
+    def __init__(self, prefs, session_info, backend=None, event_trace=None):
+        self.prefs = prefs
+        self.session_info = session_info
+        # All requests to the X server go through the backend
+        self.backend = backend if backend is not None else XlibBackend()
+        self.event_trace = event_trace
+        self.dpy_root = self.backend.root
+        self.pixel_palette = PixelPalette(self.backend.colormap)
+
+        self.display_dimensions = self.get_display_geometry()
+        self.monitor_layout = MonitorLayout(self.backend)
+        self.border_pixels = self.get_border_pixels()
+        self.titlebar_height = 20 if self.prefs.appearance.get("titlebars", 0) == 1 else 0
+        self.titlebar_pixels = self.get_titlebar_pixels() if self.titlebar_height > 0 else None
+        self.window_resize_options = [
+            "center",
+            "maximize",
+            "left",
+            "right",
+            "top",
+            "bottom"
+        ]
+
+        self.window_records = {}  # Window ID -> WindowRecord, in the order windows were managed
+        self.frame_records = {}  # Frame window ID -> WindowRecord of the window inside it
+        self.focus_history = OrderedDict()  # Window IDs, most recently focused last
+        self.switcher_candidates = None  # Windows offered by a running Alt+Tab session, most recent first
+        self.switcher_index = 0
+        self.last_raised_window = None
+        self.deskbar_update_pending = False
+        self.focused_window = None
+        self.focus_border_window = None
+        self.active_window_title = self.session_info.session_name
+        self.window_order = -1
+
+        self.key_alias = {}
+
+        self.start = None
+        self.attr = None
+        self.drag_window = None
+        self.drag_geometry = None  # Geometry the dragged window is being moved or resized to
+        self.drag_outline = None  # Outline drawn on the root in outline mode, or None
+
+        self.restart_pending = False  # Set by Alt+R or SIGHUP, the restart happens between event batches
+        self.restart_geometries = {}  # Window ID -> Geometry it had before the restart, until decorated
+        self.handler_timings = None  # Event type, or "flush" -> list of durations, collected by TraceReplayer
+        self.wm_window_type = self.backend.intern_atom('_NET_WM_WINDOW_TYPE')
+        self.wm_state = self.backend.intern_atom('_NET_WM_STATE')
+        self.wm_pid = self.backend.intern_atom('_NET_WM_PID')
+        self.wm_name_atoms = (Xatom.WM_NAME, self.backend.intern_atom('_NET_WM_NAME'))
+        self.restart_state_atom = self.backend.intern_atom('_BISCUITWM_RESTART_STATE')
+        self.wm_window_types = {
+            "dock": self.backend.intern_atom('_NET_WM_WINDOW_TYPE_DOCK'),
+            "normal": self.backend.intern_atom('_NET_WM_WINDOW_TYPE_NORMAL'),
+            "dialog": self.backend.intern_atom('_NET_WM_WINDOW_TYPE_DIALOG'),
+            "utility": self.backend.intern_atom('_NET_WM_WINDOW_TYPE_UTILITY'),
+            "toolbar": self.backend.intern_atom('_NET_WM_WINDOW_TYPE_TOOLBAR'),
+            "menu": self.backend.intern_atom('_NET_WM_WINDOW_TYPE_MENU'),
+            "splash": self.backend.intern_atom('_NET_WM_WINDOW_TYPE_SPLASH')
+        }
+        self.wm_window_status = {
+            "active": self.backend.intern_atom('_NET_ACTIVE_WINDOW'),
+            "desktop": self.backend.intern_atom('_NET_WM_DESKTOP'),
+            "above": self.backend.intern_atom('_NET_WM_STATE_ABOVE'),
+            "skip_taskbar": self.backend.intern_atom('_NET_WM_STATE_SKIP_TASKBAR'),
+            "maximize_vertical": self.backend.intern_atom('_NET_WM_STATE_MAXIMIZED_VERT'),
+            "maximize_horizontal": self.backend.intern_atom('_NET_WM_STATE_MAXIMIZED_HORIZ')
+        }
+
+        self.wm_window_cyclical = [
+            self.wm_window_types["normal"],
+            self.wm_window_types["dialog"],
+            self.wm_window_types["utility"],
+            self.wm_window_types["toolbar"]
+        ]
+        self.window_rules = WindowRules(self.prefs.rules, self.wm_window_types)
+        self.geometry_store = GeometryStore() if self.prefs.placement.get("remember_geometry", 0) == 1 else None
+
+        self.deskbar = None  # Deskbar of the primary monitor, which hosts the launcher
+        self.deskbars = []
+        self.display_corners = []
+        self.stacking_order = StackingOrder(self.dpy_root)
+        self.deskbar_sampler = DeskbarSampler(self.prefs)
+        self.request_shadow = RequestShadow(self.backend)
+        self.net_wm_state = NetWMState(self.backend)
+        self.focus_policy = FocusPolicy(self.prefs)
+        self.frame_pool = FramePool(self.backend)
+        self.wallpaper_cache = WallpaperCache()
+        self.wallpaper_key = None  # Key of the wallpaper pixmap on the root, if there is one
+        self.command_index = CommandIndex()
+        self.process_supervisor = ProcessSupervisor()
+        self.profiler = SamplingProfiler()
+
+        self.update_active_window_title_rt = RepeatedTimer(interval=1, function=self.update_active_window_title)
+        self.update_active_window_title_rt.stop()
+
+        self.backend.set_cursor(self.dpy_root)
+
+    ### QUERY METHODS
+
+    def get_display_geometry(self):
+        return self.backend.get_root_geometry()
+
+    def window_list(self):
+        return self.backend.query_children()
+
+    def get_window_record(self, window):
+        return self.window_records.get(window.id)
+
+    def get_managed_windows(self):
+        return [record.window for record in self.window_records.values()]
+
+    def is_frame(self, window):
+        return window.id in self.frame_records
+
+    def get_client_window(self, window):
+        # Events on a frame are handled as events on the window inside it
+        record = self.frame_records.get(window.id)
+        if record is None:
+            return window
+        return record.window
+
+    def get_outer_window(self, window):
+        # The window that is a child of the root: the frame if there is one
+        record = self.window_records.get(window.id)
+        if record is None or record.frame is None:
+            return window
+        return record.frame.window
+
+    def is_managed_window(self, window):
+        return window.id in self.window_records
+
+    def get_window_type(self, window):
+        record = self.get_window_record(window)
+        if record is not None and record.window_type is not None:
+            return record.window_type if record.window_type != X.NONE else None
+        value = self.backend.get_property(window, self.wm_window_type, Xatom.ATOM)
+        window_type = value[0] if value is not None else X.NONE
+        if record is not None:
+            record.window_type = window_type
+        return window_type if window_type != X.NONE else None
+
+    def is_dock(self, window):
+        return self.get_window_type(window) == self.wm_window_types["dock"]
+
+    def is_popup_window(self, window):
+        return self.get_window_type(window) in (self.wm_window_types["menu"], self.wm_window_types["splash"])
+
+    def is_cyclical_window(self, window):
+        return self.get_window_type(window) in self.wm_window_cyclical
+
+    def is_deskbar(self, window):
+        return self.get_deskbar(window) is not None
+
+    def get_deskbar(self, window):
+        for deskbar in self.deskbars:
+            if window == deskbar.deskbar:
+                return deskbar
+        return None
+
+    def is_active(self, atom):
+        if atom == self.wm_window_status["active"]:
+            return True
+        return False
+
+    def get_active_window(self):
+        return self.backend.get_property(self.dpy_root, self.wm_window_status["active"], Xatom.ATOM)
+
+    def get_window_class(self, window):
+        record = self.get_window_record(window)
+        if record is not None and record.window_class is not None:
+            return record.window_class
+        cls = self.backend.get_window_class(window)
+        if record is not None:
+            record.window_class = cls
+        if cls is not None:
+            return cls
+        else:
+            return ''
+
+    def get_window_pid(self, window):
+        value = self.backend.get_property(window, self.wm_pid, Xatom.CARDINAL)
+        if value is None:
             return None
+        return int(value[0])
+
+    def get_window_geometry(self, window):
+        # Geometry of the outer window, which for a frame the WM already knows
+        outer_window = self.get_outer_window(window)
+        if outer_window != window:
+            geometry = self.request_shadow.get_geometry(outer_window)
+            if geometry is not None:
+                return geometry
+        return self.backend.get_window_geometry(outer_window)
+
+    def get_monitor_work_area(self, monitor):
+        # Monitor geometry minus the deskbar drawn along its top edge
+        deskbar_height = 0 if self.deskbar is None else self.deskbar.real_height
+        return monitor.x, monitor.y + deskbar_height, monitor.width, monitor.height - deskbar_height
+
+    def get_window_monitor(self, window):
+        geometry = self.request_shadow.get_geometry(self.get_outer_window(window))
+        if geometry is None:
+            geometry = self.get_window_geometry(window)
+        if geometry is None:
+            return self.monitor_layout.primary()
+        return self.monitor_layout.monitor_for_geometry(geometry.x, geometry.y, geometry.width, geometry.height)
+
+    def get_pointer_monitor(self):
+        try:
+            pointer_x, pointer_y = self.backend.query_pointer()
+        except error.XError:
+            return self.monitor_layout.primary()
+        return self.monitor_layout.monitor_at(pointer_x, pointer_y)
+
+    def get_window_attributes(self, window):
+        return self.backend.get_window_attributes(window)
 
     def get_window_state(self, window):
-        return self.ewmh.getWmState(window, str=True)
+        return self.net_wm_state.get_states(window)
 
     def get_window_shortname(self, window):
         return '0x{:x} [{}]'.format(window.id, self.get_window_class(window))
 
     def get_window_title(self, window):
-        result = None
-        try:
-            result = window.get_wm_name()
-        except:
-            pass
-        if result is None:
+        record = self.get_window_record(window)
+        if record is not None and record.title is not None:
+            return record.title or self.session_info.session_name
+        result = self.backend.get_window_title(window)
+        if record is not None:
+            record.title = result or ""  # Cache untitled windows too
+        if not result:
             return self.session_info.session_name
         return result
 
@@ -725,159 +3006,444 @@ class WindowManager(object):
             window_title = custom_title
         else:
             self.active_window_title = window_title
-        if self.prefs.deskbar["enabled"] == 1:
-            self.deskbar.set_active_window_title(self.active_window_title)
+        for deskbar in self.deskbars:
+            deskbar.set_active_window_title(self.active_window_title)
 
     def update_active_window_title(self):
         if self.last_raised_window is not None:
             self.set_active_window_title(self.last_raised_window)
 
     def update_window_count(self):
-        if self.deskbar is not None:
-            self.deskbar.set_window_count(len(self.managed_windows))
+        for deskbar in self.deskbars:
+            deskbar.set_window_count(len(self.window_records))
 
     ### WINDOW CONTROLS
 
-    def manage_window(self, window):
-        attributes = self.get_window_attributes(window)
-        if attributes is None:
-            return
-        if attributes.override_redirect:
-            return
+    def manage_window(self, window, record=None):
+        if record is None:
+            attributes = self.get_window_attributes(window)
+            if attributes is None:
+                return
+            if attributes.override_redirect:
+                return
+            record = WindowRecord(window)
+        # Otherwise the record was handed over by a restart, see adopt_windows
         if self.is_managed_window(window):
             return
 
+        self.window_records[window.id] = record
         if self.prefs.dev["debug"] == 1:
             print("Found window: %s", self.get_window_shortname(window))
-        self.managed_windows.append(window)
-        self.exposed_windows.append(window)
-        self.window_order = len(self.managed_windows) - 1
+        self.window_order = len(self.window_records) - 1
+        self.focus_history[window.id] = None
+        self.focus_history.move_to_end(window.id, last=False)  # Least recent until it is focused
         self.update_window_count()
+        if len(self.process_supervisor.children) > 0:
+            record.pid = self.get_window_pid(window)
+            self.process_supervisor.claim_window(window.id, record.pid)
+        if self.window_rules.has_rules():
+            record.rule_actions = self.window_rules.match(
+                self.get_window_class(window), self.get_window_type(window), lambda: self.get_window_title(window)
+            )
 
-        window.map()
-        mask = X.EnterWindowMask | X.LeaveWindowMask
-        window.change_attributes(event_mask=mask)
+        if self.titlebar_height > 0 and self.is_dock(window) is False:
+            self.frame_window(record, self.restart_geometries.get(window.id))
+        else:
+            self.backend.map_window(window)
+            mask = X.EnterWindowMask | X.LeaveWindowMask | X.FocusChangeMask | X.PropertyChangeMask
+            self.backend.select_input(window, mask)
+        if self.focus_policy.click_focus:
+            self.backend.grab_click(window)
 
         self.decorate_window(window)
 
-    def unmanage_window(self, window):
+    def frame_window(self, record, frame_geometry=None):
+        window = record.window
+        if frame_geometry is None:
+            geometry = self.backend.get_window_geometry(window)
+            if geometry is None:
+                return
+            frame_geometry = Geometry(geometry.x, geometry.y, geometry.width, geometry.height + self.titlebar_height)
+        x, y, width, height = frame_geometry.as_tuple()
+        border_width = self.get_border_width(window)
+        # Crossing and button events are taken on the frame, which includes the titlebar
+        frame_mask = (
+            X.SubstructureNotifyMask | X.EnterWindowMask | X.LeaveWindowMask | X.ExposureMask |
+            X.ButtonPressMask | X.ButtonReleaseMask | X.ButtonMotionMask
+        )
+        frame, created = self.frame_pool.acquire(
+            x, y, width, height, border_width, self.titlebar_pixels["unfocused"][0], frame_mask
+        )
+        record.frame = frame
+        self.frame_records[frame.window.id] = record
+        if created:
+            self.request_shadow.set_geometry(frame.window, x=x, y=y, width=width, height=height)
+        else:
+            self.request_shadow.configure(frame.window, x=x, y=y, width=width, height=height)
+        self.request_shadow.configure(window, border_width=0)
+        # Place the frame before the window appears in it
+        self.request_shadow.flush()
+
+        self.backend.select_input(window, X.FocusChangeMask | X.PropertyChangeMask)
+        self.backend.add_to_save_set(window)
+        self.backend.reparent_window(window, frame.window, 0, self.titlebar_height)
+        self.backend.map_window(window)
+        self.backend.map_window(frame.window)
+
+    def unframe_window(self, record, alive=True):
+        frame = record.frame
+        record.frame = None
+        del self.frame_records[frame.window.id]
+        if alive:
+            # Put the window back where the frame was
+            geometry = self.request_shadow.get_geometry(frame.window)
+            x, y = (geometry.x, geometry.y) if geometry is not None else (0, 0)
+            self.backend.reparent_window(record.window, self.dpy_root, x, y)
+            self.backend.remove_from_save_set(record.window)
+        if self.frame_pool.release(frame):
+            self.request_shadow.forget(frame.window)
+
+    def unmanage_window(self, window, alive=True):
         if self.is_managed_window(window):
             if self.prefs.dev["debug"] == 1:
                 print("Unmanaging window: %s", self.get_window_shortname(window))
-            if window in self.managed_windows:
-                self.managed_windows.remove(window)
-                self.window_order = len(self.managed_windows) - 1
-                self.update_window_count()
-            if window in self.exposed_windows:
-                self.exposed_windows.remove(window)
+            if self.geometry_store is not None:
+                self.remember_window_geometry(window)
+            record = self.window_records.pop(window.id)
+            if record.frame is not None:
+                self.unframe_window(record, alive)
+            self.net_wm_state.forget(window)
+            if alive and self.focus_policy.click_focus:
+                self.backend.ungrab_click(window)
+            self.focus_policy.leave(window)
+            del self.focus_history[window.id]
+            self.window_order = len(self.window_records) - 1
+            self.update_window_count()
+            if self.switcher_candidates is not None and window in self.switcher_candidates:
+                self.remove_switcher_candidate(window)
+            self.process_supervisor.release_window(window.id)
+            if window == self.focused_window:
+                self.focused_window = None
+            if window == self.focus_border_window:
+                self.focus_border_window = None
+            if window == self.last_raised_window:
+                self.last_raised_window = None
+            if self.start is not None and window == self.drag_window:
+                self.finish_drag()  # Also releases the server grab of outline mode
+            self.request_shadow.forget(window)
+
+    def remember_window_geometry(self, window):
+        # Only what the WM already knows, the window may be gone from the server. Dialogs and other
+        # transient windows share the class of the main window, so only normal windows are remembered.
+        record = self.get_window_record(window)
+        if record.window_type != self.wm_window_types["normal"]:
+            return
+        geometry = record.restore_geometry or self.request_shadow.get_geometry(self.get_outer_window(window))
+        window_class = self.get_window_class(window) if record.window_class is None else record.window_class
+        if geometry is not None and len(window_class) > 0:
+            self.geometry_store.remember(window_class, geometry)
+
+    def forget_window(self, window):
+        # The window is gone from the server, so drop everything cached about it
+        self.unmanage_window(window, alive=False)
+        self.request_shadow.forget(window)
+        self.net_wm_state.forget(window)
+
+    def prune_dead_windows(self):
+        # Evict windows the server reported as gone through BadWindow or BadDrawable errors
+        for window_id in self.backend.take_dead_window_ids():
+            record = self.window_records.get(window_id)
+            if record is not None:
+                if self.prefs.dev["debug"] == 1:
+                    print("Pruning dead window: 0x{:x}".format(window_id))
+                self.forget_window(record.window)
+            else:
+                self.request_shadow.forget_id(window_id)
+                self.net_wm_state.forget_id(window_id)
+            self.stacking_order.remove(window_id)
 
     def destroy_window(self, window):
         if self.is_dock(window) is False:
             if self.prefs.dev["debug"] == 1:
                 print("Destroy window: %s", self.get_window_shortname(window))
             if self.is_managed_window(window):
-                window.destroy()
-                self.unmanage_window(window)
+                self.backend.destroy_window(window)
+                self.unmanage_window(window, alive=False)
 
     def raise_window(self, window):
+        # Nothing to do if the window is already on top of the managed windows
+        outer_window = self.get_outer_window(window)
+        if window == self.last_raised_window and self.stacking_order.is_top(outer_window.id):
+            return
         if not self.is_dock(window):
             if not self.is_managed_window(window):
                 return
-            window.raise_window()
+            self.backend.raise_window(outer_window)
+            self.stacking_order.raise_window(outer_window.id)
             self.last_raised_window = window
             self.set_active_window_title(window)
-            if self.deskbar is not None:
-                self.deskbar.update()
+            self.deskbar_update_pending = True  # Redrawn once per batch by flush_requests
 
     def focus_window(self, window):
-        if self.is_dock(window) or not self.is_managed_window(window) or not self.is_alive_window(window):
+        # Nothing to do if the window already has both input focus and the focus border
+        if window == self.focused_window and window == self.focus_border_window:
             return
-        window.set_input_focus(X.RevertToParent, 0)
-        self.set_focus_window_border(window)
+        # Dead windows are evicted by prune_dead_windows, so no liveness round trip is needed
+        if self.is_dock(window) or not self.is_managed_window(window):
+            return
+        if window != self.focused_window:
+            self.backend.set_input_focus(window)
+            self.backend.change_property(self.dpy_root, self.wm_window_status["active"], Xatom.WINDOW, [window.id])
+            self.focused_window = window
+            self.focus_history.move_to_end(window.id)
+        if window != self.focus_border_window:
+            self.set_focus_window_border(window)
+
+    def apply_hover_focus(self):
+        # Focus the window the pointer settled on, if it has rested there long enough
+        window = self.focus_policy.take_due_window()
+        if window is None or not self.is_managed_window(window):
+            return
+        if self.get_rule_action(window, "focus", 1) == 0:
+            return
+        self.focus_window(window)
+        if self.prefs.placement["auto_window_raise"] == 1:
+            self.raise_window(window)
+        else:
+            self.set_active_window_title(window)
 
     def cycle_windows(self):
-        if len(self.managed_windows) > 0:
-            self.window_order += 1
-            if self.window_order > len(self.managed_windows) - 1:
-                self.window_order = 0
-            window = self.managed_windows[self.window_order]
-            if self.is_cyclical_window(window) is False:
-                if self.window_order >= len(self.managed_windows) - 1:
-                    self.window_order = 0
-                else:
-                    self.window_order += 1
-                window = self.managed_windows[self.window_order]
+        # Focus the next cyclical window in the order windows were managed
+        managed_windows = self.get_managed_windows()
+        for step in range(1, len(managed_windows) + 1):
+            index = (self.window_order + step) % len(managed_windows)
+            if self.is_cyclical_window(managed_windows[index]):
+                self.window_order = index
+                self.focus_window(managed_windows[index])
+                self.raise_window(managed_windows[index])
+                return
+        self.window_order = -1
+
+    ### WINDOW SWITCHER
+
+    def get_switcher_candidates(self):
+        # Window types are cached in the records, so this needs no server queries
+        return [
+            self.window_records[window_id].window for window_id in reversed(self.focus_history)
+            if self.is_cyclical_window(self.window_records[window_id].window)
+        ]
+
+    def get_switcher_text(self):
+        titles = []
+        for index, window in enumerate(self.switcher_candidates):
+            title = self.get_window_title(window)
+            if len(title) > 24:
+                title = title[:23] + "~"
+            titles.append("[" + title + "]" if index == self.switcher_index else title)
+        return "  ".join(titles)
+
+    def preview_window_switcher(self):
+        if self.deskbar is not None:
+            self.deskbar.show_switcher(self.get_switcher_text())
+
+    def start_window_switcher(self):
+        candidates = self.get_switcher_candidates()
+        if len(candidates) == 0:
+            return
+        # Hold the keyboard so the release of Alt is reported to the WM
+        if not self.backend.grab_keyboard():
+            print("Unable to grab the keyboard for the window switcher")
+            return
+        self.switcher_candidates = candidates
+        self.switcher_index = 1 % len(candidates)  # Start at the previously focused window
+        self.preview_window_switcher()
+        # A quick Alt+Tab may release Alt before the grab, and that release is never reported
+        if not self.backend.query_modifiers() & X.Mod1Mask:
+            self.finish_window_switcher()
+
+    def advance_window_switcher(self, step):
+        self.switcher_index = (self.switcher_index + step) % len(self.switcher_candidates)
+        self.preview_window_switcher()
+
+    def remove_switcher_candidate(self, window):
+        index = self.switcher_candidates.index(window)
+        del self.switcher_candidates[index]
+        if len(self.switcher_candidates) == 0:
+            self.finish_window_switcher(commit=False)
+            return
+        if index < self.switcher_index or self.switcher_index == len(self.switcher_candidates):
+            self.switcher_index -= 1
+        self.preview_window_switcher()
+
+    def finish_window_switcher(self, commit=True):
+        window = self.switcher_candidates[self.switcher_index] if len(self.switcher_candidates) > 0 else None
+        self.switcher_candidates = None
+        self.switcher_index = 0
+        self.backend.ungrab_keyboard()
+        if self.deskbar is not None:
+            self.deskbar.hide_switcher()
+        if commit and window is not None:
             self.focus_window(window)
             self.raise_window(window)
-        else:
-            self.window_order = -1
+
+    def handle_window_switcher(self, ev):
+        if ev.type == X.KeyPress:
+            if ev.detail == self.key_alias["Tab"]:
+                self.advance_window_switcher(-1 if ev.state & X.ShiftMask else 1)
+            elif ev.detail == self.key_alias["Escape"]:
+                self.finish_window_switcher(commit=False)
+        elif ev.detail in (self.key_alias["Alt_L"], self.key_alias["Alt_R"]):
+            self.finish_window_switcher()
 
     ### WINDOW DECORATION
 
     def is_window_maximized(self, window):
-        states = self.get_window_state(window)
-        print(states)
+        return (
+            self.net_wm_state.has_state(window, "_NET_WM_STATE_MAXIMIZED_VERT") and
+            self.net_wm_state.has_state(window, "_NET_WM_STATE_MAXIMIZED_HORIZ")
+        )
 
-    def move_window(self, xdiff, ydiff):
-        window_dimensions = self.get_window_geometry(self.start.child)
-        if self.deskbar is not None and ydiff < 0 and window_dimensions.y <= self.deskbar.real_height:
-            y = self.deskbar.real_height
+    def restore_window(self, window):
+        # Undo a maximize, back to where the window was before it
+        record = self.get_window_record(window)
+        if record is None or record.restore_geometry is None:
+            self.resize_window(window, "center")
+            return
+        self.net_wm_state.change(
+            window, NetWMState.REMOVE, "_NET_WM_STATE_MAXIMIZED_VERT", "_NET_WM_STATE_MAXIMIZED_HORIZ"
+        )
+        self.configure_window(window, **record.restore_geometry.as_dict())
+        record.restore_geometry = None
+
+    def configure_window(self, window, **values):
+        # values describe the outer window, the window inside a frame fills it below the titlebar
+        record = self.window_records.get(window.id)
+        if record is None or record.frame is None:
+            self.request_shadow.configure(window, **values)
+            return
+        self.request_shadow.configure(record.frame.window, **values)
+        client_values = {}
+        if "width" in values:
+            client_values["width"] = values["width"]
+        if "height" in values:
+            client_values["height"] = max(1, values["height"] - self.titlebar_height)
+        if len(client_values) > 0:
+            self.request_shadow.configure(window, **client_values)
+
+    def handle_client_configure_notify(self, record, ev):
+        # A framed window resized itself, so resize the frame around it
+        geometry = self.request_shadow.get_geometry(record.frame.window)
+        width, height = ev.width, ev.height + self.titlebar_height
+        if geometry is not None and (geometry.width, geometry.height) != (width, height):
+            self.request_shadow.configure(record.frame.window, width=width, height=height)
+
+    def is_outline_mode(self):
+        return self.prefs.placement.get("outline_move_resize", 0) == 1
+
+    def get_drag_geometry(self, xdiff, ydiff):
+        # Geometry for a drag of (xdiff, ydiff) from the start of the drag, based on where it last was
+        window_dimensions = self.drag_geometry
+        monitor = self.monitor_layout.monitor_for_geometry(
+            window_dimensions.x, window_dimensions.y, window_dimensions.width, window_dimensions.height
+        )
+        area_x, area_y, area_width, area_height = self.get_monitor_work_area(monitor)
+        if self.deskbar is not None and ydiff < 0 and window_dimensions.y <= area_y:
+            # Snap to the bottom of the deskbar
+            y = area_y
         else:
             y = self.attr.y + (self.start.detail == 1 and ydiff or 0)
-        self.start.child.configure(
-            x=self.attr.x + (self.start.detail == 1 and xdiff or 0),
-            y=y,
-            width=max(1, self.attr.width + (self.start.detail == 3 and xdiff or 0)),
-            height=max(1, self.attr.height + (self.start.detail == 3 and ydiff or 0))
+        return Geometry(
+            self.attr.x + (self.start.detail == 1 and xdiff or 0),
+            y,
+            max(1, self.attr.width + (self.start.detail == 3 and xdiff or 0)),
+            max(1, self.attr.height + (self.start.detail == 3 and ydiff or 0))
         )
 
+    def draw_drag_outline(self, geometry):
+        # XOR drawing, so drawing the previous outline again erases it
+        border_width = self.prefs.appearance["window_border_width"]
+        if self.drag_outline is not None:
+            self.backend.draw_outline(*self.drag_outline)
+            self.drag_outline = None
+        if geometry is not None:
+            self.drag_outline = (
+                geometry.x, geometry.y,
+                geometry.width + border_width * 2 - 1, geometry.height + border_width * 2 - 1,
+                max(1, border_width)
+            )
+            self.backend.draw_outline(*self.drag_outline)
+
+    def start_drag(self, ev, window):
+        self.attr = self.get_window_geometry(window)
+        if self.attr is None:
+            return
+        self.start = ev
+        self.drag_window = window
+        self.drag_geometry = Geometry(self.attr.x, self.attr.y, self.attr.width, self.attr.height)
+        if self.is_outline_mode():
+            # Send the raise and border first, then keep other clients from drawing over the outline
+            self.request_shadow.flush()
+            self.backend.grab_server()
+            self.draw_drag_outline(self.drag_geometry)
+
+    def move_window(self, xdiff, ydiff):
+        self.drag_geometry = self.get_drag_geometry(xdiff, ydiff)
+        if self.is_outline_mode():
+            self.draw_drag_outline(self.drag_geometry)
+        else:
+            self.configure_window(self.drag_window, **self.drag_geometry.as_dict())
+
+    def finish_drag(self):
+        if self.start is None:
+            return
+        if self.drag_outline is not None:
+            # The client only gets the final geometry
+            self.draw_drag_outline(None)
+            self.backend.ungrab_server()
+            if self.is_managed_window(self.drag_window):
+                self.configure_window(self.drag_window, **self.drag_geometry.as_dict())
+        # A moved or resized window is no longer maximized
+        if self.is_managed_window(self.drag_window):
+            self.net_wm_state.change(
+                self.drag_window, NetWMState.REMOVE, "_NET_WM_STATE_MAXIMIZED_VERT", "_NET_WM_STATE_MAXIMIZED_HORIZ"
+            )
+            self.get_window_record(self.drag_window).restore_geometry = None
+        self.start = None
+        self.attr = None
+        self.drag_window = None
+        self.drag_geometry = None
+
     def resize_window(self, window, position):
         if self.is_dock(window) is False:
             if self.prefs.dev["debug"] == 1:
                 print("Triggered window resize")
             if position in self.window_resize_options:
-                window_x, window_y, window_width, window_height = None, None, None, None
+                monitor = self.get_window_monitor(window)
+                window_dimensions = None
                 if position == "center":
                     window_dimensions = self.get_window_geometry(window)
-                    window_width, window_height = window_dimensions.width, window_dimensions.height
-                    window_x = (self.display_dimensions.width - window_width) // 2
-                    window_y = (self.display_dimensions.height - window_height) // 2
-                elif position == "maximize":
-                    window_width, window_height, has_deskbar = self.get_maximum_available_geometry()
-                    window_x = -self.prefs.appearance["window_border_width"]
-                    window_y = -self.prefs.appearance["window_border_width"] if not has_deskbar else (
-                            -self.prefs.appearance["window_border_width"] + self.deskbar.real_height
-                    )
-                elif position == "left" or position == "right":
-                    window_width = self.display_dimensions.width // 2
-                    window_height = self.display_dimensions.height + (
-                        0 if self.deskbar is None else self.deskbar.height)
-                    if position == "left":
-                        window_x = -self.prefs.appearance["window_border_width"]
-                    elif position == "right":
-                        window_x = window_width - self.prefs.appearance["window_border_width"]
-                    window_y = -self.prefs.appearance["window_border_width"] if self.deskbar is None else (
-                            -self.prefs.appearance[
-                                "window_border_width"] + self.deskbar.height + self.deskbar.border_width
-                    )
-                elif position == "top" or position == "bottom":
-                    window_width = self.display_dimensions.width
-                    window_height = (self.display_dimensions.height + (
-                        0 if self.deskbar is None else self.deskbar.height)) // 2
-                    if position == "top":
-                        window_y = -self.prefs.appearance["window_border_width"]
-                    elif position == "bottom":
-                        window_y = window_height + self.prefs.appearance["window_border_width"]
-                    window_x = -self.prefs.appearance["window_border_width"]
-
-                if position == "maximize":
-                    self.ewmh.setWmState(window, 1, "_NET_WM_STATE_MAXIMIZED_VERT")
-                    self.ewmh.setWmState(window, 1, "_NET_WM_STATE_MAXIMIZED_HORIZ")
-                else:
-                    self.ewmh.setWmState(window, 0, "_NET_WM_STATE_MAXIMIZED_VERT")
-                    self.ewmh.setWmState(window, 0, "_NET_WM_STATE_MAXIMIZED_HORIZ")
+                    if window_dimensions is None:
+                        return
+                window_x, window_y, window_width, window_height = self.get_resize_geometry(
+                    position, monitor, window_dimensions
+                )
 
-                window.configure(
+                record = self.get_window_record(window)
+                if record is not None:
+                    if position != "maximize":
+                        record.restore_geometry = None
+                    elif not self.is_window_maximized(window):
+                        geometry = self.get_window_geometry(window)
+                        if geometry is not None:
+                            record.restore_geometry = Geometry(geometry.x, geometry.y, geometry.width, geometry.height)
+                self.net_wm_state.change(
+                    window,
+                    NetWMState.ADD if position == "maximize" else NetWMState.REMOVE,
+                    "_NET_WM_STATE_MAXIMIZED_VERT",
+                    "_NET_WM_STATE_MAXIMIZED_HORIZ"
+                )
+                self.configure_window(
+                    window,
                     x=window_x,
                     y=window_y,
                     width=window_width,
@@ -886,69 +3452,205 @@ class WindowManager(object):
             else:
                 print("Invalid window position: " + position)
 
+    def get_resize_geometry(self, position, monitor, window_dimensions=None):
+        # Pure placement math, window_dimensions is only needed to center
+        window_x, window_y, window_width, window_height = None, None, None, None
+        border_width = self.prefs.appearance["window_border_width"]
+        area_x, area_y, area_width, area_height = self.get_monitor_work_area(monitor)
+        if position == "center":
+            window_width, window_height = window_dimensions.width, window_dimensions.height
+            window_x = monitor.x + (monitor.width - window_width) // 2
+            window_y = monitor.y + (monitor.height - window_height) // 2
+        elif position == "maximize":
+            window_width, window_height = area_width, area_height
+            window_x = area_x - border_width
+            window_y = area_y - border_width
+        elif position == "left" or position == "right":
+            window_width = area_width // 2
+            window_height = area_height
+            if position == "left":
+                window_x = area_x - border_width
+            elif position == "right":
+                window_x = area_x + window_width - border_width
+            window_y = area_y - border_width
+        elif position == "top" or position == "bottom":
+            window_width = area_width
+            window_height = area_height // 2
+            if position == "top":
+                window_y = area_y - border_width
+            elif position == "bottom":
+                window_y = area_y + window_height - border_width
+            window_x = area_x - border_width
+        return window_x, window_y, window_width, window_height
+
+    def get_placement_geometry(self, monitor, window_dimensions):
+        # Pure placement math for a newly managed window
+        window_width, window_height = window_dimensions.width, window_dimensions.height
+        window_x = 5
+        window_y = 25
+        # Move new window out of the way of the deskbar
+        if self.prefs.placement["auto_window_fit"] == 1:
+            # Resize window to fit the screen
+            if window_dimensions.width + window_x >= monitor.width:
+                window_width -= window_x * 2
+            if window_dimensions.height + window_y >= monitor.height:
+                window_height -= window_y * 2
+        window_x += monitor.x
+        window_y += monitor.y
+        if self.prefs.placement["center_window_placement"] == 1:
+            window_x = monitor.x + (monitor.width - window_width) // 2
+            window_y = monitor.y + (monitor.height - window_height) // 2
+        return window_x, window_y, window_width, window_height
+
+    def get_rule_action(self, window, action, default=None):
+        record = self.get_window_record(window)
+        if record is None or record.rule_actions is None:
+            return default
+        return record.rule_actions.get(action, default)
+
+    def get_border_width(self, window):
+        return self.get_rule_action(window, "border_width", self.prefs.appearance["window_border_width"])
+
+    def get_initial_geometry(self, window):
+        # Geometry from the window rules first, then the remembered geometry, then automatic placement
+        rule_geometry = {}
+        for key in ("x", "y", "width", "height"):
+            value = self.get_rule_action(window, key)
+            if value is not None:
+                rule_geometry[key] = value
+        if len(rule_geometry) > 0:
+            window_dimensions = self.get_window_geometry(window)
+            if window_dimensions is None:
+                return None
+            geometry = Geometry(window_dimensions.x, window_dimensions.y, window_dimensions.width, window_dimensions.height)
+            return Geometry(**dict(geometry.as_dict(), **rule_geometry))
+        if self.geometry_store is not None and self.get_window_type(window) == self.wm_window_types["normal"]:
+            geometry = self.geometry_store.get(self.get_window_class(window))
+            # Skip geometry left on a monitor that is no longer there
+            if geometry is not None and any(
+                monitor.contains(geometry.x + geometry.width // 2, geometry.y + geometry.height // 2)
+                for monitor in self.monitor_layout.monitors
+            ):
+                return geometry
+        if self.prefs.placement["auto_window_placement"] == 1:
+            window_dimensions = self.get_window_geometry(window)
+            if window_dimensions is None:
+                return None
+            # Place new windows on the monitor under the pointer
+            return Geometry(*self.get_placement_geometry(self.get_pointer_monitor(), window_dimensions))
+        return None
+
     def decorate_window(self, window):
-        self.set_cursor(window)
+        self.backend.set_cursor(window)
         if self.is_dock(window) is False:
-            window_dimensions = self.get_window_geometry(window)
-            window_width, window_height = window_dimensions.width, window_dimensions.height
-            window_x = 5
-            window_y = 25
-            if self.prefs.placement["auto_window_placement"] == 1:
-                # Move new window out of the way of the deskbar
-                if self.prefs.placement["auto_window_fit"] == 1:
-                    # Resize window to fit the screen
-                    if window_dimensions.width + window_x >= self.display_dimensions.width:
-                        window_width -= window_x * 2
-                    if window_dimensions.height + window_y >= self.display_dimensions.height:
-                        window_height -= window_y * 2
-                if self.prefs.placement["center_window_placement"] == 1:
-                    window_x = (self.display_dimensions.width - window_width) // 2
-                    window_y = (self.display_dimensions.height - window_height) // 2
-                window.configure(
-                    x=window_x,
-                    y=window_y,
-                    width=window_width,
-                    height=window_height
-                )
+            position = self.get_rule_action(window, "position")
+            if window.id in self.restart_geometries:
+                # Windows stay where they were before a restart
+                geometry = self.restart_geometries.pop(window.id)
+                if geometry is not None:
+                    self.configure_window(window, **geometry.as_dict())
+            elif position is not None:
+                self.resize_window(window, position)
+            else:
+                geometry = self.get_initial_geometry(window)
+                if geometry is not None:
+                    self.configure_window(window, **geometry.as_dict())
             self.set_unfocus_window_border(window)
 
+    def get_border_pixels(self):
+        unfocused_pixel = self.pixel_palette.get_named_pixel("lightgray")
+        if self.prefs.appearance["inactive_window_border_color"] in self.pixel_palette.hex_map.keys():
+            unfocused_pixel = self.pixel_palette.get_named_pixel(self.prefs.appearance["inactive_window_border_color"])
+        elif self.pixel_palette.is_color_hex(self.prefs.appearance["inactive_window_border_color"]) is True:
+            unfocused_pixel = self.pixel_palette.get_hex_pixel(self.prefs.appearance["inactive_window_border_color"])
+        focused_pixel = self.pixel_palette.get_named_pixel("sienna")
+        if self.prefs.appearance["active_window_border_color"] in self.pixel_palette.hex_map.keys():
+            focused_pixel = self.pixel_palette.get_named_pixel(self.prefs.appearance["active_window_border_color"])
+        elif self.pixel_palette.is_color_hex(self.prefs.appearance["active_window_border_color"]) is True:
+            focused_pixel = self.pixel_palette.get_hex_pixel(self.prefs.appearance["active_window_border_color"])
+        return {
+            "focused": focused_pixel,
+            "unfocused": unfocused_pixel
+        }
+
+    def get_titlebar_pixels(self):
+        # Background and text pixels of the focused and unfocused titlebar styles
+        return {
+            "focused": (self.border_pixels["focused"], self.pixel_palette.get_named_pixel("white")),
+            "unfocused": (self.border_pixels["unfocused"], self.pixel_palette.get_named_pixel("black"))
+        }
+
+    def draw_titlebar(self, record, force=False):
+        # Only redraw when the title or focus changed, or the server asked for it
+        frame = record.frame
+        title = self.get_window_title(record.window)
+        focused = record.window == self.focus_border_window
+        if not force and title == frame.drawn_title and focused == frame.drawn_focused:
+            return
+        geometry = self.request_shadow.get_geometry(frame.window)
+        width = geometry.width if geometry is not None else self.display_dimensions.width
+        background_pixel, foreground_pixel = self.titlebar_pixels["focused" if focused else "unfocused"]
+        self.backend.draw_titlebar(
+            frame.window, width, self.titlebar_height, background_pixel, foreground_pixel, title
+        )
+        frame.drawn_title = title
+        frame.drawn_focused = focused
+
     def set_unfocus_window_border(self, window):
         if not self.is_dock(window):
-            border_color = self.pixel_palette.get_named_pixel("lightgray")
-            if self.prefs.appearance["inactive_window_border_color"] in self.pixel_palette.hex_map.keys():
-                border_color = self.pixel_palette.get_named_pixel(self.prefs.appearance["inactive_window_border_color"])
-            elif self.pixel_palette.is_color_hex(self.prefs.appearance["inactive_window_border_color"]) is True:
-                border_color = self.pixel_palette.get_hex_pixel(self.prefs.appearance["inactive_window_border_color"])
-            window.configure(border_width=self.prefs.appearance["window_border_width"])
-            window.change_attributes(None, border_pixel=border_color)
+            outer_window = self.get_outer_window(window)
+            self.request_shadow.configure(outer_window, border_width=self.get_border_width(window))
+            self.request_shadow.set_border_pixel(outer_window, self.border_pixels["unfocused"])
+            if window == self.focus_border_window:
+                self.focus_border_window = None
+            record = self.get_window_record(window)
+            if record is not None and record.frame is not None:
+                self.draw_titlebar(record)
 
     def set_focus_window_border(self, window):
         if not self.is_dock(window):
-            border_color = self.pixel_palette.get_named_pixel("sienna")
-            if self.prefs.appearance["active_window_border_color"] in self.pixel_palette.hex_map.keys():
-                border_color = self.pixel_palette.get_named_pixel(self.prefs.appearance["active_window_border_color"])
-            elif self.pixel_palette.is_color_hex(self.prefs.appearance["active_window_border_color"]) is True:
-                border_color = self.pixel_palette.get_hex_pixel(self.prefs.appearance["active_window_border_color"])
-            window.change_attributes(None, border_pixel=border_color)
-
-    def set_cursor(self, window):
-        font = self.dpy.open_font('cursor')
-        cursor = font.create_glyph_cursor(
-            font,
-            Xcursorfont.left_ptr,
-            Xcursorfont.left_ptr + 1,
-            (65535, 65535, 65535),
-            (0, 0, 0)
-        )
-        window.change_attributes(cursor=cursor)
-
-    def set_background_color(self):
-        background_color = self.pixel_palette.hex_map["slategray"]
+            # Only one window shows the focused border
+            if self.focus_border_window is not None and self.focus_border_window != window:
+                self.set_unfocus_window_border(self.focus_border_window)
+            self.request_shadow.set_border_pixel(self.get_outer_window(window), self.border_pixels["focused"])
+            self.focus_border_window = window
+            record = self.get_window_record(window)
+            if record is not None and record.frame is not None:
+                self.draw_titlebar(record)
+
+    def get_background_pixel(self):
+        background_pixel = self.pixel_palette.get_named_pixel("slategray")
         if self.pixel_palette.is_color_hex(self.prefs.appearance["background_color"]) is True:
-            background_color = self.prefs.appearance["background_color"]
+            background_pixel = self.pixel_palette.get_hex_pixel(self.prefs.appearance["background_color"])
         elif self.prefs.appearance["background_color"] in self.pixel_palette.hex_map.keys():
-            background_color = self.pixel_palette.hex_map[self.prefs.appearance["background_color"]]
-        os.system('xsetroot -solid "' + background_color + '"')
+            background_pixel = self.pixel_palette.get_named_pixel(self.prefs.appearance["background_color"])
+        return background_pixel
+
+    def get_wallpaper_pixmap(self, path):
+        raw_mode = self.backend.get_image_format()
+        if raw_mode is None:
+            print("Wallpapers need a 24-bit true colour display")
+            return None, None
+        width, height = self.display_dimensions.width, self.display_dimensions.height
+        data = self.wallpaper_cache.load(path, width, height, raw_mode)
+        if data is None:
+            return None, None
+        key = ("wallpaper", path, width, height)
+        return self.backend.create_image_pixmap(key, width, height, data), key
+
+    def set_background(self):
+        wallpaper_path = self.prefs.appearance.get("wallpaper", "")
+        pixmap, key = None, None
+        if len(wallpaper_path) > 0:
+            pixmap, key = self.get_wallpaper_pixmap(os.path.expanduser(wallpaper_path))
+        if pixmap is not None:
+            self.backend.set_root_background(pixmap=pixmap)
+        else:
+            self.backend.set_root_background(pixel=self.get_background_pixel())
+        # A wallpaper for the previous screen size is no longer needed
+        if self.wallpaper_key is not None and self.wallpaper_key != key:
+            self.backend.free_pixmap(self.wallpaper_key)
+        self.wallpaper_key = key
 
     # DEBUG
 
@@ -982,36 +3684,55 @@ class WindowManager(object):
     # SPECIAL
 
     def start_terminal(self):
-        run_command('x-terminal-emulator')
+        self.process_supervisor.spawn('x-terminal-emulator')
 
     # EVENT HANDLING
 
     def keycode_to_string(self, detail):
-        return XK.keysym_to_string(self.dpy.keycode_to_keysym(detail, 0))
+        return XK.keysym_to_string(self.backend.keycode_to_keysym(detail, 0))
 
     def set_key_aliases(self):
         keystrings = [
             "x", "q",
             "minus", "equal", "bracketleft", "bracketright", "backslash", "slash",
-            "F1", "Tab", "Escape", "space", "Return", "BackSpace"
+            "F1", "Tab", "Escape", "space", "Return", "BackSpace", "Alt_L", "Alt_R", "p", "r"
         ]
         for keystring in keystrings:
-            self.key_alias[keystring] = self.dpy.keysym_to_keycode(XK.string_to_keysym(keystring))
+            self.key_alias[keystring] = self.backend.keysym_to_keycode(XK.string_to_keysym(keystring))
+
+    def update_launcher_completion(self):
+        command_string = self.deskbar.command_string
+        completion = None
+        if len(command_string.split()) == 1 and not command_string[-1].isspace():
+            completion = self.command_index.complete(command_string)
+        if completion is not None:
+            self.deskbar.command_completion = completion[len(command_string):]
+        else:
+            self.deskbar.command_completion = ""
 
     def handle_launcher(self, ev):
         if ev.detail == self.key_alias["Escape"]:
             self.deskbar.toggle_launcher(state=False)
         elif ev.detail == self.key_alias["BackSpace"] and len(self.deskbar.command_string) > 0:
             self.deskbar.command_string = self.deskbar.command_string[:-1]
+            self.update_launcher_completion()
+            self.deskbar.update()
+        elif ev.detail == self.key_alias["Tab"]:
+            # Accept the inline completion
+            self.deskbar.command_string += self.deskbar.command_completion
+            self.update_launcher_completion()
             self.deskbar.update()
         elif ev.detail == self.key_alias["Return"]:
-            run_command(self.deskbar.command_string)
+            command_words = self.deskbar.command_string.split()
+            if len(command_words) > 0 and self.process_supervisor.spawn(self.deskbar.command_string) is not None:
+                self.command_index.record_launch(command_words[0])
             self.deskbar.toggle_launcher(state=False)
         else:
             try:
                 key_pressed = self.keycode_to_string(ev.detail)
                 if key_pressed is not None:
                     self.deskbar.command_string += key_pressed
+                    self.update_launcher_completion()
                     self.deskbar.update()
             except:
                 print("Invalid key press detection")
@@ -1039,150 +3760,526 @@ class WindowManager(object):
                 self.focus_window(ev.window)
                 self.raise_window(ev.window)
             elif ev.detail == self.key_alias["Tab"]:
-                self.cycle_windows()
+                self.start_window_switcher()
+            elif ev.detail == self.key_alias["p"]:
+                self.toggle_profiler()
+            elif ev.detail == self.key_alias["r"]:
+                self.restart_pending = True
             elif ev.detail == self.key_alias["space"]:
                 if self.deskbar is not None:
+                    self.command_index.refresh_async()
                     self.deskbar.toggle_launcher(state=True)
             elif ev.detail == self.key_alias["Escape"]:
                 self.end_session()
         else:
             print("Key is not aliased")
 
+    def handle_event(self, ev):
+        if self.prefs.dev["debug"] == 1:
+            self.print_event_type(ev)
+        self.stacking_order.handle_event(ev)
+        if ev.type == X.ConfigureNotify:
+            self.request_shadow.handle_configure_notify(ev)
+            record = self.frame_records.get(ev.event.id)
+            if record is not None and ev.window == record.window:
+                self.handle_client_configure_notify(record, ev)
+        elif self.backend.is_screen_change_event(ev):
+            self.handle_screen_change()
+
+        if ev.type == X.MapNotify:
+            self.set_active_window_title(self.get_client_window(ev.window))
+
+        if ev.type in (X.KeyPress, X.KeyRelease) and self.switcher_candidates is not None:
+            self.handle_window_switcher(ev)
+        elif ev.type == X.KeyPress:
+            if self.deskbar is not None and self.deskbar.launcher_is_running() is True:
+                self.handle_launcher(ev)
+            else:
+                self.handle_keypress(ev)
+        elif ev.type == X.MapNotify:
+            # Frames, and windows mapped inside them, are already managed
+            if ev.event == self.dpy_root and not self.is_frame(ev.window) and self.is_cyclical_window(ev.window):
+                self.manage_window(ev.window)
+                if self.get_rule_action(ev.window, "focus", 1) == 1:
+                    self.focus_window(ev.window)
+                self.raise_window(ev.window)
+        elif ev.type == X.DestroyNotify:
+            self.forget_window(ev.window)
+        elif ev.type == X.ClientMessage:
+            self.handle_client_message(ev)
+        elif ev.type == X.UnmapNotify and self.is_frame(ev.event):
+            # A framed window withdrew itself, so hand it back to the root
+            if ev.window == self.frame_records[ev.event.id].window:
+                self.unmanage_window(ev.window)
+        elif ev.type == X.PropertyNotify and ev.atom in self.wm_name_atoms:
+            record = self.get_window_record(ev.window)
+            if record is not None:
+                record.title = None
+                if record.frame is not None:
+                    self.draw_titlebar(record)
+                if ev.window == self.last_raised_window:
+                    self.set_active_window_title(ev.window)
+        elif ev.type == X.EnterNotify:
+            # Focusing waits until the pointer settles, see apply_hover_focus
+            self.focus_policy.enter(self.get_client_window(ev.window))
+        elif ev.type == X.LeaveNotify:
+            # Moving from the titlebar into the framed window does not leave the frame
+            if ev.detail != X.NotifyInferior or not self.is_frame(ev.window):
+                window = self.get_client_window(ev.window)
+                self.focus_policy.leave(window)
+                # With click to focus, the focused window keeps its border wherever the pointer is
+                if self.focus_policy.focus_on_hover:
+                    self.set_unfocus_window_border(window)
+        elif ev.type == X.Expose and ev.count == 0:
+            # Deskbars and titlebars are only redrawn on changes, so repaint them when uncovered
+            deskbar = self.get_deskbar(ev.window)
+            if deskbar is not None:
+                deskbar.update()
+            elif self.is_frame(ev.window):
+                self.draw_titlebar(self.frame_records[ev.window.id], force=True)
+        elif ev.type == X.FocusOut:
+            # Another client took the focus, so the next focus_window must not be skipped
+            if ev.window == self.focused_window and ev.mode == X.NotifyNormal and ev.detail != X.NotifyInferior:
+                self.focused_window = None
+        elif ev.type == X.ButtonPress and ev.event != self.dpy_root and self.is_managed_window(ev.event):
+            # A click caught by grab_click, focus the window and then let the client have the click
+            self.focus_window(ev.event)
+            if self.focus_policy.raise_on_click:
+                self.raise_window(ev.event)
+            self.backend.replay_pointer()
+        elif ev.type == X.ButtonPress and self.is_frame(ev.event):
+            # Clicks on a frame focus and raise the window, and dragging the titlebar moves it
+            window = self.frame_records[ev.event.id].window
+            self.focus_window(window)
+            self.raise_window(window)
+            if ev.detail == 1 and ev.event_y < self.titlebar_height:
+                self.start_drag(ev, window)
+        elif ev.type == X.ButtonPress and ev.child != X.NONE:
+            child = self.get_client_window(ev.child)
+            if not self.is_dock(child):
+                self.raise_window(child)
+                self.set_focus_window_border(child)
+                self.start_drag(ev, child)
+            elif self.is_deskbar(ev.child):
+                if ev.detail == 1:
+                    self.cycle_windows()
+                elif ev.detail == 3:
+                    for deskbar in self.deskbars:
+                        deskbar.toggle_window_count()
+                    self.update_deskbars()
+        elif ev.type == X.MotionNotify and self.start:
+            xdiff = ev.root_x - self.start.root_x
+            ydiff = ev.root_y - self.start.root_y
+            self.move_window(xdiff, ydiff)
+        elif ev.type == X.ButtonRelease:
+            self.finish_drag()
+
+    def handle_client_message(self, ev):
+        if not self.is_managed_window(ev.window):
+            return
+        data_format, data = ev.data
+        if ev.client_type == self.wm_state:
+            self.handle_wm_state_message(ev.window, data[0], [atom for atom in data[1:3] if atom != X.NONE])
+        elif ev.client_type == self.wm_window_status["active"]:
+            self.focus_window(ev.window)
+            self.raise_window(ev.window)
+
+    def handle_wm_state_message(self, window, action, atoms):
+        # Maximizing is the only state the WM acts on, either direction maximizes both ways
+        maximize_atoms = (self.wm_window_status["maximize_vertical"], self.wm_window_status["maximize_horizontal"])
+        if not any(atom in maximize_atoms for atom in atoms):
+            return
+        maximized = self.is_window_maximized(window)
+        if action == NetWMState.TOGGLE:
+            action = NetWMState.REMOVE if maximized else NetWMState.ADD
+        if action == NetWMState.ADD and not maximized:
+            self.resize_window(window, "maximize")
+        elif action == NetWMState.REMOVE and maximized:
+            self.restore_window(window)
+
+    def flush_requests(self):
+        # Drop windows that died since the last batch before sending requests for them
+        self.prune_dead_windows()
+        for display_corners in self.display_corners:
+            display_corners.update()
+        if self.deskbar_update_pending:
+            self.deskbar_update_pending = False
+            self.update_deskbars()
+        self.request_shadow.flush()
+        self.net_wm_state.flush()
+        self.backend.flush()
+
     def loop(self):
         while 1:
-            ev = self.dpy.next_event()
-            if self.prefs.dev["debug"] == 1:
-                self.print_event_type(ev)
+            if self.restart_pending:
+                self.restart()
+            timeout = self.focus_policy.get_timeout()
+            if timeout is not None and self.backend.pending_events() == 0:
+                # Crossings are settled once the queue is drained and no event comes within the hover delay
+                if not self.backend.wait_for_event(timeout):
+                    self.apply_hover_focus()
+                    self.flush_requests()
+                    continue
+            # Take everything already queued, so the whole batch is sent with one flush
+            events = [self.backend.next_event()]
+            while len(events) < EVENT_BATCH_LIMIT and self.backend.pending_events() > 0:
+                events.append(self.backend.next_event())
+            if self.event_trace is not None:
+                self.event_trace.record_batch(events)
+            self.handle_events(events)
+
+    def handle_events(self, events):
+        # Handle one batch of events, sending its requests with one flush
+        if self.handler_timings is None:
+            for ev in self.coalesce_events(events):
+                self.handle_event(ev)
+            self.flush_requests()
+            return
+        for ev in self.coalesce_events(events):
+            start = time.perf_counter()
+            self.handle_event(ev)
+            self.handler_timings.setdefault(ev.type, []).append(time.perf_counter() - start)
+        start = time.perf_counter()
+        self.flush_requests()
+        self.handler_timings.setdefault("flush", []).append(time.perf_counter() - start)
+
+    def coalesce_events(self, events):
+        # Drop events that a later event of the same batch makes redundant. Everything else keeps its order.
+        coalesced = []
+        later_motion = False
+        crossed_window_ids = set()
+        changed_properties = set()
+        for ev in reversed(events):
+            if ev.type == X.MotionNotify:
+                # Only the last position of a drag matters
+                if later_motion:
+                    continue
+                later_motion = True
+            elif ev.type in (X.ButtonPress, X.ButtonRelease, X.KeyPress, X.KeyRelease):
+                # Motion before a press or release is still handled before it
+                later_motion = False
+            elif ev.type in (X.EnterNotify, X.LeaveNotify) and ev.detail != X.NotifyInferior:
+                # The last crossing of each window wins
+                if ev.window.id in crossed_window_ids:
+                    continue
+                crossed_window_ids.add(ev.window.id)
+            elif ev.type == X.PropertyNotify:
+                # A property changed several times is read once
+                if (ev.window.id, ev.atom) in changed_properties:
+                    continue
+                changed_properties.add((ev.window.id, ev.atom))
+            coalesced.append(ev)
+        coalesced.reverse()
+        return coalesced
+
+    def draw_deskbars(self):
+        # One deskbar per monitor
+        if self.prefs.deskbar["enabled"] == 1:
+            self.deskbar_sampler.start()
+            for monitor in self.monitor_layout.monitors:
+                deskbar = Deskbar(
+                    self.backend.dpy, self.dpy_root, self.backend.screen, monitor,
+                    self.wm_window_type, self.wm_window_types,
+                    self.wm_state, self.wm_window_status,
+                    self.prefs, self.session_info, self.deskbar_sampler,
+                    self.backend.resources
+                )
+                deskbar.draw()
+                self.deskbars.append(deskbar)
+            self.deskbar = self.deskbars[0]
+            self.update_window_count()
+
+    def stop_deskbars(self):
+        for deskbar in self.deskbars:
+            deskbar.stop()
+        self.deskbars = []
+        self.deskbar = None
 
-            if ev.type in [X.EnterNotify, X.LeaveNotify, X.MapNotify]:
-                self.set_active_window_title(ev.window)
+    def update_deskbars(self):
+        for deskbar in self.deskbars:
+            deskbar.update()
 
-            if ev.type == X.KeyPress:
-                if self.deskbar is not None and self.deskbar.launcher_is_running() is True:
-                    self.handle_launcher(ev)
-                else:
-                    self.handle_keypress(ev)
-            elif ev.type == X.MapNotify:
-                if self.is_cyclical_window(ev.window):
-                    try:
-                        self.manage_window(ev.window)
-                        self.focus_window(ev.window)
-                        self.raise_window(ev.window)
-                    except AttributeError:
-                        print("Unable to handle new window")
-                        pass
-            elif ev.type == X.DestroyNotify:
-                try:
-                    self.destroy_window(ev.window)
-                except AttributeError:
-                    print("Unable to unhandle new window")
-                    pass
-            elif ev.type == X.EnterNotify:
-                self.focus_window(ev.window)
-                if self.prefs.placement["auto_window_raise"] == 1:
-                    self.raise_window(ev.window)
-            elif ev.type == X.LeaveNotify:
-                self.set_unfocus_window_border(ev.window)
-            elif ev.type == X.ButtonPress and ev.child != X.NONE:
-                if not self.is_dock(ev.child):
-                    self.raise_window(ev.child)
-                    self.set_focus_window_border(ev.child)
-                    self.attr = ev.child.get_geometry()
-                    self.start = ev
-                elif self.deskbar is not None and ev.child == self.deskbar.deskbar:
-                    if ev.detail == 1:
-                        self.cycle_windows()
-                    elif ev.detail == 3:
-                        self.deskbar.toggle_window_count()
-                        self.deskbar.update()
-            elif ev.type == X.MotionNotify and self.start:
-                xdiff = ev.root_x - self.start.root_x
-                ydiff = ev.root_y - self.start.root_y
-                self.move_window(xdiff, ydiff)
-            elif ev.type == X.ButtonRelease:
-                self.start = None
-                self.attr = None
-                if ev.child != X.NONE and self.is_dock(ev.child) is False:
-                    self.ewmh.setWmState(ev.window, 0, "_NET_WM_STATE_MAXIMIZED_VERT")
-                    self.ewmh.setWmState(ev.window, 0, "_NET_WM_STATE_MAXIMIZED_HORIZ")
-
-            if self.display_corners is not None:
-                self.display_corners.update()
-            self.dpy.flush()
+    def draw_display_corners(self):
+        # One set of display corners per monitor
+        if self.prefs.xround["enabled"] == 1:
+            for monitor in self.monitor_layout.monitors:
+                display_corners = DisplayCorners(
+                    self.backend.dpy, self.dpy_root, self.backend.screen, monitor,
+                    self.wm_window_type, self.wm_window_types,
+                    self.wm_state, self.wm_window_status,
+                    self.stacking_order, self.backend.resources
+                )
+                display_corners.draw()
+                self.display_corners.append(display_corners)
+
+    def stop_display_corners(self):
+        for display_corners in self.display_corners:
+            display_corners.stop()
+        self.display_corners = []
+
+    def handle_screen_change(self):
+        if not self.monitor_layout.refresh():
+            return
+        if self.prefs.dev["debug"] == 1:
+            print("Monitor layout changed: %s" % [monitor.as_tuple() for monitor in self.monitor_layout.monitors])
+        self.display_dimensions = self.get_display_geometry()
+        self.set_background()
+        self.stop_deskbars()
+        self.stop_display_corners()
+        self.draw_deskbars()
+        self.draw_display_corners()
+        self.set_active_window_title(self.last_raised_window)
+        self.update_deskbars()
+        # Bring back windows left outside of every remaining monitor
+        for window in self.get_managed_windows():
+            geometry = self.request_shadow.get_geometry(self.get_outer_window(window))
+            if geometry is None:
+                continue
+            center_x, center_y = geometry.x + geometry.width // 2, geometry.y + geometry.height // 2
+            if not any(monitor.contains(center_x, center_y) for monitor in self.monitor_layout.monitors):
+                self.resize_window(window, "center")
 
     def main(self):
+        # Reap launched commands as soon as they exit
+        self.process_supervisor.install()
+        # Print the memory report on demand
+        signal.signal(signal.SIGUSR1, self.print_memory_report)
+        # Start and stop the sampling profiler on demand
+        signal.signal(signal.SIGUSR2, self.toggle_profiler)
+        # Restart in place, keeping the managed windows as they are
+        signal.signal(signal.SIGHUP, self.request_restart)
+
         # Register keyboard and mouse events
         self.set_key_aliases()
-        self.dpy_root.grab_key(
-            X.AnyKey,
-            X.Mod1Mask | X.Mod2Mask,
-            1,
-            X.GrabModeAsync,
-            X.GrabModeAsync
-        )
-        self.dpy_root.grab_button(
+        if self.event_trace is not None:
+            self.event_trace.write_header(self.dpy_root, self.display_dimensions, self.key_alias)
+        self.backend.grab_key(X.AnyKey, X.Mod1Mask | X.Mod2Mask)
+        self.backend.grab_button(
             1,
             X.Mod1Mask | X.Mod2Mask,
-            1,
-            X.ButtonPressMask | X.ButtonReleaseMask | X.PointerMotionMask,
-            X.GrabModeAsync,
-            X.GrabModeAsync,
-            X.NONE,
-            X.NONE
+            X.ButtonPressMask | X.ButtonReleaseMask | X.PointerMotionMask
         )
-        self.dpy_root.grab_button(
+        self.backend.grab_button(
             3,
             X.Mod1Mask | X.Mod2Mask,
-            1,
-            X.ButtonPressMask | X.ButtonReleaseMask | X.PointerMotionMask,
-            X.GrabModeAsync,
-            X.GrabModeAsync,
-            X.NONE,
-            X.NONE
+            X.ButtonPressMask | X.ButtonReleaseMask | X.PointerMotionMask
         )
-        self.dpy_root.change_attributes(event_mask=X.SubstructureNotifyMask)
-
-        self.set_background_color()
-
+        self.backend.select_root_input(X.SubstructureNotifyMask)
+        self.backend.select_screen_change_input()
+        # Tell clients which hints the WM handles
+        self.backend.change_property(self.dpy_root, self.backend.intern_atom("_NET_SUPPORTED"), Xatom.ATOM, [
+            self.wm_state,
+            self.wm_window_status["maximize_vertical"],
+            self.wm_window_status["maximize_horizontal"],
+            self.wm_window_status["active"]
+        ])
+
+        self.set_background()
+
+        restart_state = self.take_restart_state()
         children = self.window_list()
-        for child in children:
-            if child.get_attributes().map_state:
-                self.manage_window(child)
-
-        # Draw deskbar
-        if self.prefs.deskbar["enabled"] == 1:
-            self.deskbar = Deskbar(
-                self.ewmh, self.dpy, self.dpy_root, self.screen, self.display_dimensions,
-                self.wm_window_type, self.wm_window_types,
-                self.wm_state, self.wm_window_status,
-                self.prefs, self.session_info
-            )
-            self.deskbar.draw()
+        self.stacking_order.reset(children)
+        if restart_state is not None:
+            self.adopt_windows(children, restart_state)
+        else:
+            for child in children:
+                attributes = self.get_window_attributes(child)
+                if attributes is not None and attributes.map_state:
+                    self.manage_window(child)
 
-        # Draw display corners
-        if self.prefs.xround["enabled"] == 1:
-            self.display_corners = DisplayCorners(
-                self.ewmh, self.dpy, self.dpy_root, self.screen, self.display_dimensions,
-                self.wm_window_type, self.wm_window_types,
-                self.wm_state, self.wm_window_status
-            )
-            self.display_corners.draw()
+        self.draw_deskbars()
+        self.draw_display_corners()
+        if restart_state is not None:
+            self.restore_session_state(restart_state)
 
         try:
             self.loop()
-        except KeyboardInterrupt or error.ConnectionClosedError:
+        except (KeyboardInterrupt, error.ConnectionClosedError):
             self.end_session()
             sys.exit(0)
 
+    def get_memory_report(self):
+        try:
+            with open("/proc/self/statm") as statm_file:
+                rss = int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            rss = 0
+        x_resources = self.backend.count_resources()
+        x_resources["deskbar"] = sum(deskbar.count_resources() for deskbar in self.deskbars)
+        x_resources["display_corners"] = sum(corners.count_resources() for corners in self.display_corners)
+        x_resources["frames"] = len(self.frame_records) + len(self.frame_pool.free_frames)
+        return {
+            "rss_kib": rss // 1024,
+            "window_records": len(self.window_records),
+            "window_shadows": len(self.request_shadow.shadows),
+            "stacked_windows": len(self.stacking_order.window_ids),
+            "child_processes": len(self.process_supervisor.children),
+            "x_resources": x_resources
+        }
+
+    def print_memory_report(self, signum=None, frame=None):
+        report = self.get_memory_report()
+        print("Memory: %d KiB RSS, %d window records, %d window shadows, %d stacked windows, %d child processes" % (
+            report["rss_kib"], report["window_records"], report["window_shadows"],
+            report["stacked_windows"], report["child_processes"]
+        ))
+        print("X resources: " + ", ".join(
+            "%s=%d" % (name, count) for name, count in sorted(report["x_resources"].items())
+        ))
+
+    def toggle_profiler(self, signum=None, frame=None):
+        if self.profiler.is_running():
+            sample_count = sum(self.profiler.samples.values())
+            path = self.profiler.stop()
+            print("Profile of %d samples written to %s" % (sample_count, path))
+        else:
+            self.profiler.start()
+            print("Profiler started")
+
+    def request_restart(self, signum=None, frame=None):
+        # Only flag the restart here, a signal may arrive in the middle of a request. The wakeup
+        # is sent from a thread so a loop blocked on the connection sees the flag.
+        self.restart_pending = True
+        Thread(target=self.backend.send_wakeup, args=(self.restart_state_atom,), daemon=True).start()
+
+    def get_restart_state(self):
+        # What the next WM process needs to take over the windows without placing them again
+        outer_to_client = {}
+        windows = []
+        for record in self.window_records.values():
+            outer_window = self.get_outer_window(record.window)
+            outer_to_client[outer_window.id] = record.window.id
+            geometry = self.request_shadow.get_geometry(outer_window)
+            windows.append({
+                "id": record.window.id,
+                "window_type": record.window_type,
+                "window_class": record.window_class,
+                "geometry": geometry.as_tuple() if geometry is not None else None,
+                "restore_geometry": record.restore_geometry.as_tuple() if record.restore_geometry is not None else None
+            })
+        return {
+            "windows": windows,  # In the order they were managed
+            "stacking": [outer_to_client[window_id] for window_id in self.stacking_order.window_ids
+                         if window_id in outer_to_client],
+            "focus_history": list(self.focus_history),
+            "focused": self.focused_window.id if self.focused_window is not None else None,
+            "children": [[pid, command_string] for pid, command_string in self.process_supervisor.children.items()],
+            "show_window_count": (
+                self.deskbar.deskbar_items["leading"]["window_count"].enabled if self.deskbar is not None else None
+            )
+        }
+
+    def take_restart_state(self):
+        text = self.backend.take_text_property(self.dpy_root, self.restart_state_atom)
+        if text is None:
+            return None
+        try:
+            return json.loads(text)
+        except ValueError:
+            print("Invalid restart state, managing windows from scratch")
+            return None
+
+    def adopt_windows(self, children, state):
+        # Manage the windows handed over by the previous WM process with what it knew about them,
+        # which saves the geometry and property queries and the placement of a cold start
+        self.process_supervisor.adopt_children(dict(state["children"]))
+        child_ids = set(child.id for child in children)
+        for saved in state["windows"]:
+            if saved["id"] not in child_ids:
+                continue  # Destroyed while the WM was restarting
+            window = self.backend.get_window(saved["id"])
+            # Windows the application hid, such as one minimized to a tray, stay hidden
+            attributes = self.get_window_attributes(window)
+            child_ids.discard(window.id)
+            if attributes is None or not attributes.map_state:
+                continue
+            record = WindowRecord(window, saved["window_type"])
+            record.window_class = saved["window_class"]
+            if saved["restore_geometry"] is not None:
+                record.restore_geometry = Geometry(*saved["restore_geometry"])
+            self.restart_geometries[window.id] = Geometry(*saved["geometry"]) if saved["geometry"] is not None else None
+            self.manage_window(window, record)
+        # Windows mapped while the WM was restarting are managed as usual
+        for child in children:
+            if child.id in child_ids:
+                attributes = self.get_window_attributes(child)
+                if attributes is not None and attributes.map_state:
+                    self.manage_window(child)
+        self.restart_geometries = {}
+
+    def restore_session_state(self, state):
+        for window_id in state["stacking"]:
+            record = self.window_records.get(window_id)
+            if record is not None:
+                self.raise_window(record.window)
+        for window_id in state["focus_history"]:
+            if window_id in self.focus_history:
+                self.focus_history.move_to_end(window_id)
+        record = self.window_records.get(state["focused"])
+        if record is not None:
+            self.focus_window(record.window)
+        show_window_count = state["show_window_count"]
+        for deskbar in self.deskbars:
+            if show_window_count is not None and deskbar.deskbar_items["leading"]["window_count"].enabled != show_window_count:
+                deskbar.toggle_window_count()
+        self.flush_requests()
+
+    def restart(self):
+        print("Restarting BiscuitWM")
+        self.backend.set_text_property(self.dpy_root, self.restart_state_atom, json.dumps(self.get_restart_state()))
+        # Closing the connection hands framed windows back to the root through the save set
+        self.close_session()
+        try:
+            os.execv(sys.executable, self.get_restart_argv())
+        except OSError as err:
+            print("Restart failed: %s" % err)
+            sys.exit(1)
+
+    def get_restart_argv(self):
+        # A second --record-trace would truncate the trace of this session, so recording ends with the restart
+        argv = [sys.executable]
+        skip_value = False
+        for arg in sys.argv:
+            option = arg.split("=", 1)[0]
+            if skip_value:
+                skip_value = False
+            elif len(option) > 2 and "--record-trace".startswith(option):
+                skip_value = "=" not in arg
+            else:
+                argv.append(arg)
+        return argv
+
     def end_session(self):
-        self.update_active_window_title_rt.stop()
-        if self.prefs.deskbar["enabled"] == 1:
-            self.deskbar.stop_repeated_events()
-        if self.prefs.xround["enabled"] == 1:
-            self.display_corners.stop()
-        self.dpy.close()
+        self.close_session()
         sys.exit(0)
 
+    def close_session(self):
+        if self.profiler.is_running():
+            self.toggle_profiler()
+        self.update_active_window_title_rt.stop()
+        self.process_supervisor.uninstall()
+        self.stop_deskbars()
+        self.deskbar_sampler.stop()
+        self.stop_display_corners()
+        if self.event_trace is not None:
+            self.event_trace.close()
+        if self.wallpaper_key is not None:
+            self.backend.forget_root_pixmap()
+        self.backend.free_resources()
+        self.backend.close()
+
 
 if __name__ == "__main__":
-    WindowManager(prefs=Preferences(), session_info=SessionInfo()).main()
+    parser = argparse.ArgumentParser(description="BiscuitWM window manager")
+    parser.add_argument("--record-trace", metavar="PATH", help="record the X event stream to a trace file")
+    parser.add_argument("--replay-trace", metavar="PATH", help="replay a trace without an X server and report timings")
+    arguments = parser.parse_args()
+    if arguments.replay_trace is not None:
+        replayer = TraceReplayer(arguments.replay_trace, prefs=Preferences(), session_info=SessionInfo())
+        replayer.report(replayer.run())
+    else:
+        WindowManager(
+            prefs=Preferences(),
+            session_info=SessionInfo(),
+            event_trace=EventTraceWriter(arguments.record_trace) if arguments.record_trace is not None else None
+        ).main()